@@ -39,6 +39,13 @@ def count(message, add_prompts=True):
 	num_tokens = anthropic.count_tokens(message)
 	return num_tokens
 
+def count_batch(messages, add_prompts=True):
+	""" Count the number of tokens in each of a list of messages, in one batch """
+	if add_prompts:
+		messages = [f"{anthropic.HUMAN_PROMPT} {message}{anthropic.AI_PROMPT}" for message in messages]
+	encodings = anthropic.get_tokenizer().encode_batch(messages)
+	return [len(encoding.ids) for encoding in encodings]
+
 def response_completion(response):
 	""" Extract the completion from a response """
 	logger.debug("Response: %s", json.dumps(response))
@@ -73,8 +80,8 @@ def message_to_string(message):
 		raise ValueError(f"unknown role: {message['role']}")
 	return f"{prompt} {message['content']}"
 
-def chat_claude(messages, model=None, token_limit: int = None, temperature=None, streaming=False, _async=False):
-	""" Chat with claude """
+def chat_claude(messages, model=None, token_limit: int = None, temperature=None, streaming=False, _async=False, client=None):
+	""" Chat with claude, using the given client or a new one """
 	real_token_limit = TOKEN_LIMIT_100K if "100k" in model else TOKEN_LIMIT
 	logger.debug("model: %s", model)
 	logger.debug("real_token_limit: %s", real_token_limit)
@@ -94,7 +101,7 @@ def chat_claude(messages, model=None, token_limit: int = None, temperature=None,
 	if token_limit > max_possible_tokens_to_sample:
 		token_limit = max_possible_tokens_to_sample
 		logger.debug("Reducing token_limit to %d", token_limit)
-	c = anthropic.Client(os.environ["ANTHROPIC_API_KEY"])
+	c = client or anthropic.Client(os.environ["ANTHROPIC_API_KEY"])
 	fn = c.completion_stream if streaming else c.completion
 	if _async:
 		fn = c.acompletion_stream if streaming else c.acompletion
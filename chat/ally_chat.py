@@ -15,6 +15,7 @@ from types import SimpleNamespace
 
 import shlex
 import readline
+import atexit
 
 import yaml
 # import regex
@@ -96,6 +97,8 @@ AGENTS_REMOTE = {
 		},
 		"model": "claude-instant-v1-100k",
 		"default_context": 1000,
+#		"fallback": ["gpt-3.5-turbo"],
+#		"hedge": 5,
 	},
 	"Bard": {
 		"name": "Jaski",
@@ -526,8 +529,13 @@ def history_write(file, history, delim="\n", mode="a", invitation=""):
 	if not file:
 		return
 	text = delim.join(history) + invitation
-	with open(file, mode, encoding="utf-8") as f:
-		f.write(text)
+	# open without truncating, so we don't empty the file under another writer's lock
+	with open(file, "a", encoding="utf-8") as f:
+		with chat.file_lock(f):
+			if mode == "w":
+				f.truncate(0)
+			f.write(text)
+			f.flush()
 
 
 def interactive(model, args):
@@ -784,7 +792,10 @@ def remote_agent(agent, query, file, args, history, history_start=0):
 			logger.debug("msg2: %r", msg2)
 			remote_messages.append(msg2)
 
-		while remote_messages and remote_messages[0]["role"] == "assistant" and "claude" in agent["model"]:
+		# an agent may list fallback models, to race them against the main model
+		models = [agent["model"], *agent.get("fallback", [])]
+
+		while remote_messages and remote_messages[0]["role"] == "assistant" and any("claude" in model for model in models):
 			remote_messages.pop(0)
 
 		# TODO this is a bit dodgy and won't work with async
@@ -794,8 +805,11 @@ def remote_agent(agent, query, file, args, history, history_start=0):
 		}
 		llm.set_opts(opts)
 
-		logger.warning("querying %r = %r", agent['name'], agent["model"])
-		output_message = llm.retry(llm.llm_chat, REMOTE_AGENT_RETRIES, remote_messages)
+		logger.warning("querying %r = %r", agent['name'], models)
+		if len(models) > 1:
+			output_message = llm.race(remote_messages, models, hedge=agent.get("hedge", llm.HEDGE_DELAY), retries=REMOTE_AGENT_RETRIES)
+		else:
+			output_message = llm.retry(llm.llm_chat, REMOTE_AGENT_RETRIES, remote_messages)
 
 		response = output_message["content"]
 		box = [response]
@@ -1054,6 +1068,7 @@ def get_opts():  # pylint: disable=too-many-statements
 	dev_group = parser.add_argument_group("Developer options")
 	dev_group.add_argument("--no-model", "-M", action="store_false", dest="model", help="Don't load the model, for testing purposes")
 	dev_group.add_argument("--dump-config", "-C", action="store_true", help="Dump the model config in YAML format, and exit")
+	dev_group.add_argument("--race-report", action="store_true", help="Write the win and latency stats of agents' fallback models to stderr at exit")
 
 	ucm.add_logging_options(parser)
 
@@ -1091,6 +1106,9 @@ def main():
 
 	args = get_opts()
 
+	if args.race_report:
+		atexit.register(llm.race_report, sys.stderr)
+
 	if args.list_models:
 		for model_name, model in models.items():
 			print(f"{model_name} ({model['abbrev']}): {model['description']}")
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+""" bb_bench.py: benchmark and fuzz the bb chat format: parse, route, render and tail synthetic rooms """
+
+import sys
+import os
+import argparse
+import logging
+import random
+import time
+import asyncio
+import tempfile
+import string
+
+import ucm
+import chat
+import conductor
+import atail
+import llm
+
+
+logger = logging.getLogger(__name__)
+
+STAGES = ["parse", "parse_llm", "format", "route", "render", "tail", "follow"]
+
+NAMES = ["Sam", "Ally", "Barbie", "Callam", "Emmy", "Dav", "Gemmy", "Claude", "Bard", "Jaski", "Frank", "Cleo", "Mira", "Nova", "Otto", "Pia"]
+
+WORDS = """the a of to and in is it you that he was for on are with as I his they be at one have this from or had by
+not word but what some we can out other were all there when up use your how said an each she which do their time if
+will way about many then them write would like so these her long make thing see him two has look more day could go
+come did number sound no most people my over know water than call first who may down side been now find""".split()
+
+FUZZ_CHARS = string.ascii_letters + string.digits + " \t:@$`|#*-_.,!?'\"\\/<>&" + "éü漢字😀 "
+
+
+def random_words(rng, n):
+	""" some random words """
+	return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def random_paragraphs(rng, max_lines):
+	""" plain prose, with some mentions and blank lines """
+	lines = []
+	for _ in range(rng.randint(1, max_lines)):
+		if lines and rng.random() < 0.2:
+			lines.append("")
+		line = random_words(rng, rng.randint(3, 30))
+		if rng.random() < 0.1:
+			line += f", {rng.choice(NAMES)}"
+		if rng.random() < 0.05:
+			line = f"@{rng.choice(NAMES)} {line}"
+		lines.append(line)
+	return lines
+
+
+def random_math(rng, max_lines):
+	""" inline and display maths """
+	lines = [f"Let $x_{i}^2 + y_{i}^2 = r^2$ for {random_words(rng, 3)}" for i in range(rng.randint(1, max(1, max_lines // 4)))]
+	lines += ["$$", r"\int_0^\infty e^{-x^2} dx = \frac{\sqrt{\pi}}{2}", "$$"]
+	return lines
+
+
+def random_code(rng, max_lines):
+	""" a fenced code block, with indentation """
+	lines = ["Here is some code:", "", "```python"]
+	for i in range(rng.randint(1, max_lines)):
+		lines.append("    " * rng.randint(0, 3) + f"x{i} = {rng.choice(WORDS)!r}  # {random_words(rng, 3)}")
+	lines.append("```")
+	return lines
+
+
+def random_table(rng, max_lines):
+	""" a markdown table """
+	cols = rng.randint(2, 6)
+	lines = ["| " + " | ".join(rng.choice(WORDS) for _ in range(cols)) + " |", "|" + "---|" * cols]
+	for _ in range(rng.randint(1, max_lines)):
+		lines.append("| " + " | ".join(str(rng.randint(0, 1000)) for _ in range(cols)) + " |")
+	return lines
+
+
+CONTENT_KINDS = [random_paragraphs] * 6 + [random_math, random_code, random_table]
+
+
+def synthetic_room(rng, messages=1000, speakers=10, max_lines=20):
+	""" generate a synthetic room, as a list of messages """
+	names = NAMES[:speakers] + [f"Agent{i}" for i in range(speakers - len(NAMES))]
+	room = []
+	for _ in range(messages):
+		lines = rng.choice(CONTENT_KINDS)(rng, max_lines)
+		# narrative messages are plain lines, and adjacent ones would merge
+		if rng.random() < 0.02 and room and "user" in room[-1]:
+			room.append({"content": random_words(rng, 10) + "\n"})
+		else:
+			room.append({"user": rng.choice(names), "content": "\n".join(lines) + "\n"})
+	return room
+
+
+def room_to_text(room):
+	""" format a room as bb text """
+	return "".join(chat.message_to_text(message) + "\n" for message in room)
+
+
+def room_to_llm_lines(room):
+	""" format a room as input for llm.lines_to_messages """
+	messages = [{"role": "user" if i % 2 == 0 else "assistant", "content": message["content"]} for i, message in enumerate(room)]
+	return [line for text in llm.messages_to_lines(messages) for line in text.splitlines()]
+
+
+def fuzz_message(rng):
+	""" a random message, with awkward characters """
+	lines = []
+	for _ in range(rng.randint(1, 5)):
+		lines.append("".join(rng.choice(FUZZ_CHARS) for _ in range(rng.randint(0, 40))))
+	content = "\n".join(lines).rstrip("\n") + "\n"
+	user = "".join(rng.choice(string.ascii_letters + " ._-") for _ in range(rng.randint(1, 12)))
+	return {"user": user, "content": content}
+
+
+def check_round_trip(room):
+	""" check that formatting and parsing a room gives back the same messages; return any mismatches """
+	text = room_to_text(room)
+	parsed = list(chat.lines_to_messages(text.splitlines(keepends=True)))
+	mismatches = []
+	if len(parsed) != len(room):
+		mismatches.append(("count", len(room), len(parsed)))
+	for expected, actual in zip(room, parsed):
+		if expected != actual:
+			mismatches.append(("message", expected, actual))
+	# the llm format strips whitespace, so check that a second round trip changes nothing
+	llm_parsed = llm.lines_to_messages(room_to_llm_lines([m for m in room if "user" in m]))
+	llm_parsed2 = llm.lines_to_messages(room_to_llm_lines(llm_parsed))
+	for expected, actual in zip(llm_parsed, llm_parsed2):
+		if expected["content"] != actual["content"]:
+			mismatches.append(("llm", expected["content"], actual["content"]))
+	return mismatches
+
+
+def fuzz(rng, iterations):
+	""" round-trip random awkward messages, and report mismatches """
+	failures = 0
+	for i in range(iterations):
+		room = [fuzz_message(rng) for _ in range(rng.randint(1, 5))]
+		mismatches = check_round_trip(room)
+		if mismatches:
+			failures += 1
+			if failures <= 5:
+				logger.error("round trip failed, iteration %d: %r", i, mismatches[0])
+	return failures
+
+
+def bench_parse(room, text, _path):
+	""" parse bb text to messages """
+	lines = text.encode("utf-8").splitlines(keepends=True)
+	return sum(1 for _ in chat.lines_to_messages(lines))
+
+
+def bench_parse_llm(room, _text, _path):
+	""" parse llm-format lines to messages """
+	lines = room_to_llm_lines(room)
+	return len(llm.lines_to_messages(lines))
+
+
+def bench_format(room, _text, _path):
+	""" format messages as bb text """
+	return len(room_to_text(room)) and len(room)
+
+
+def bench_route(room, _text, _path):
+	""" route each message incrementally, as the conductor does """
+	agents = {name.lower(): {"name": name, "type": "ai"} for name in NAMES[:4]}
+	router = conductor.RoomRouter(agents, default=NAMES[1])
+	for message in room:
+		router.route(message)
+	return len(room)
+
+
+def bench_render(room, _text, _path):
+	""" render messages to HTML """
+	for message in room:
+		chat.message_to_html(message)
+	return len(room)
+
+
+def bench_tail(_room, _text, path):
+	""" read the whole room file with atail """
+	async def tail():
+		count = 0
+		async for lines in atail.AsyncTail(path, all_lines=True, batch=True).run():
+			count += len(lines)
+		return count
+	return asyncio.run(tail())
+
+
+def bench_follow(_room, text, path, chunk_size=65536):
+	""" follow the room file with atail.multi while it is appended in chunks """
+	data = text.encode("utf-8")
+	lines_expected = data.count(b"\n")
+
+	async def follow():
+		with open(path, "wb"):
+			pass
+		follower = atail.MultiTail().tail(path, all_lines=True)
+		count = 0
+
+		async def write():
+			with open(path, "ab") as f:
+				for i in range(0, len(data), chunk_size):
+					f.write(data[i:i+chunk_size])
+					f.flush()
+					await asyncio.sleep(0)
+
+		writer = asyncio.create_task(write())
+		async for _line in follower:
+			count += 1
+			if count == lines_expected:
+				break
+		await writer
+		return count
+	return asyncio.run(follow())
+
+
+def run_benchmark(stages, room, repeat=3, out=sys.stdout):
+	""" time each stage on the room, and print throughput in MB/s and messages/s """
+	text = room_to_text(room)
+	size_mb = len(text.encode("utf-8")) / 1e6
+	fd, path = tempfile.mkstemp(suffix=".bb")
+	try:
+		with os.fdopen(fd, "w", encoding="utf-8") as f:
+			f.write(text)
+		print("stage", "seconds", "MB/s", "msg/s", sep="\t", file=out)
+		for stage in stages:
+			fn = globals()[f"bench_{stage}"]
+			best = None
+			for _ in range(repeat):
+				start = time.perf_counter()
+				fn(room, text, path)
+				elapsed = time.perf_counter() - start
+				best = elapsed if best is None else min(best, elapsed)
+			print(stage, f"{best:.4f}", f"{size_mb / best:.2f}", f"{len(room) / best:.0f}", sep="\t", file=out)
+			out.flush()
+	finally:
+		os.unlink(path)
+
+
+def bb_bench(opts, out=sys.stdout):
+	""" generate a room, check it round-trips, fuzz, and run the benchmarks """
+	rng = random.Random(opts.seed)
+	room = synthetic_room(rng, messages=opts.messages, speakers=opts.speakers, max_lines=opts.max_lines)
+	text = room_to_text(room)
+	logger.info("room: %d messages, %d bytes", len(room), len(text.encode("utf-8")))
+
+	mismatches = check_round_trip(room)
+	for mismatch in mismatches[:5]:
+		logger.error("round trip failed: %r", mismatch)
+	failures = 1 if mismatches else 0
+
+	if opts.fuzz:
+		failures += fuzz(rng, opts.fuzz)
+		logger.info("fuzz: %d of %d failed", failures, opts.fuzz)
+
+	stages = [stage for stage in opts.stages if stage not in (opts.skip or ())]
+	run_benchmark(stages, room, repeat=opts.repeat, out=out)
+	return failures
+
+
+def get_opts():
+	""" Get the command line options """
+	parser = argparse.ArgumentParser(description="bb_bench: benchmark and fuzz the bb chat format", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('-n', '--messages', type=int, default=10000, help="number of messages in the synthetic room")
+	parser.add_argument('-u', '--speakers', type=int, default=10, help="number of speakers")
+	parser.add_argument('-l', '--max-lines', type=int, default=20, help="maximum lines per message")
+	parser.add_argument('-s', '--stages', nargs="*", default=STAGES, choices=STAGES, help="stages to benchmark")
+	parser.add_argument('-x', '--skip', nargs="*", choices=STAGES, help="stages to skip")
+	parser.add_argument('-r', '--repeat', type=int, default=3, help="repeat each stage, and report the best time")
+	parser.add_argument('-f', '--fuzz', type=int, default=0, help="number of random rooms to round-trip")
+	parser.add_argument('-S', '--seed', type=int, default=0, help="random seed")
+	ucm.add_logging_options(parser)
+	opts = parser.parse_args()
+	return opts
+
+
+def main():
+	""" Main function """
+	opts = get_opts()
+	ucm.setup_logging(opts)
+	failures = bb_bench(opts)
+	sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+	main()
@@ -8,6 +8,8 @@ from pathlib import Path
 import re
 import logging
 from typing import Dict, Optional
+import fcntl
+from contextlib import contextmanager
 
 import argh
 import markdown
@@ -118,6 +120,17 @@ def sanitize_pathname(room):
 	return room
 
 
+@contextmanager
+def file_lock(f, shared=False):
+	""" Hold an exclusive advisory lock on an open chat file, so appends from different processes don't interleave.
+	A shared lock lets readers see the file and its archive index together, see room_archive.py. """
+	fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+	try:
+		yield
+	finally:
+		fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def split_message_line(line):
 	""" Split a message line into user and content. """
 
@@ -5,21 +5,26 @@
 import sys
 import argparse
 import logging
-from pathlib import Path
 import re
 import random
+import asyncio
+from collections import namedtuple, OrderedDict, deque
+import shlex
 
 from watchfiles import Change
 import regex
 
 import ucm
-import atail
+import awatch
 import chat
 
 
 logger = logging.getLogger(__name__)
 
 
+# the AI agents in ally_chat, which can't be imported here
+DEFAULT_AGENTS = ("Ally", "Barbie", "Callam", "Emmy", "Dav", "Claud", "Clia", "Jaski")
+
 # disabled "everyone" for now; keep it simple
 # EVERYONE_WORDS = ["everyone", "anyone", "all", "y'all"]
 
@@ -78,127 +83,331 @@ def who_should_respond(message, agents=None, history=None, default=None, include
 	""" who should respond to a message """
 	if not history:
 		history = []
-	if not agents:
-		agents = []
-
-	agents = agents.copy()
-
-	all_people = participants(history)
-	for person in all_people:
-		person_lc = person.lower()
-		if person_lc not in agents:
-			agents[person_lc] = {
-				"name": person,
+	router = RoomRouter(agents, default=default)
+	for past in history[:-1]:
+		router.add(past)
+	if history:
+		router.add_participant(history[-1].get("user"))
+	return router.route(message, include_self=include_self)
+
+
+class RoomRouter:
+	""" incremental routing state for a room, so we needn't rescan the history for each message """
+
+	def __init__(self, agents=None, default=None):
+		""" Initialize the RoomRouter object """
+		self.agents = dict(agents or {})
+		self.default = default
+		self.speakers = OrderedDict()
+		self.matchers = {}
+
+	def add_participant(self, user):
+		""" add someone who spoke in the room to the agents, as a person """
+		if not user:
+			return
+		user_lc = user.lower()
+		if user_lc not in self.agents:
+			self.agents[user_lc] = {
+				"name": user,
 				"type": "person",
 			}
-
-	agent_names = list(agents.keys())
-
-	agents_lc = list(map(str.lower, agent_names))
-
-	agents_lc_to_agents = dict(zip(agents_lc, agents))
-
-	user = message.get("user")
-	if user:
+			self.matchers.clear()
+
+	def add(self, message):
+		""" update the state for a message appended to the room """
+		user = message.get("user")
+		if not user:
+			return
+		self.add_participant(user)
 		user_lc = user.lower()
-	else:
-		user_lc = None
-
-	logger.warning("user, user_lc: %r %r", user, user_lc)
-
-	if user_lc in agents_lc:
-		user_agent = agents[user_lc]
-		logger.warning('user_agent["type"]: %r', user_agent["type"])
-		if user_agent["type"] == "tool":
-			invoked = who_spoke_last(history[:-1], user, agents, include_self=include_self)
-			return invoked
-
-	is_person = user_lc in agents_lc and agents[user_lc]["type"] == "person"
-
-	if not is_person:
-		include_self = False
-
-	content = message["content"]
-
-	agents_with_at = [f"@{agent}" for agent in agent_names]
-
-	invoked = who_is_named(content, f"@{user}", agents_with_at, include_self=include_self)
-	logger.warning("who_is_named @: %r", invoked)
-	if not invoked:
-		invoked = who_is_named(content, user, agent_names, include_self=include_self)
-		logger.warning("who_is_named 2: %r", invoked)
-	if not invoked:
-		invoked = who_spoke_last(history[:-1], user, agents, include_self=include_self)
-		logger.warning("who_spoke_last 2: %r", invoked)
-	if not invoked and default and user_lc != default.lower() and agents[user_lc]["type"] == "person":
-		invoked = [default]
-		logger.warning("default %r", invoked)
-
-	invoked = [agents_lc_to_agents.get(agent_lc, agent_lc) for agent_lc in invoked]
-
-	return invoked
+		self.speakers[user_lc] = user
+		self.speakers.move_to_end(user_lc)
+
+	def participants(self):
+		""" the names of everyone who has spoken in the room """
+		return list(self.speakers.values())
+
+	def route(self, message, include_self=True):
+		""" who should respond to a message; then add it to the state """
+		user = message.get("user")
+		user_lc = user.lower() if user else None
+		self.add_participant(user)
+		user_agent = self.agents.get(user_lc)
+
+		if user_agent and user_agent["type"] == "tool":
+			invoked = self.who_spoke_last(user_lc, include_self=include_self)
+		else:
+			if not (user_agent and user_agent["type"] == "person"):
+				include_self = False
+			content = message["content"]
+			invoked = self.who_is_named(content, user_lc, include_self=include_self, at=True)
+			if not invoked:
+				invoked = self.who_is_named(content, user_lc, include_self=include_self)
+			if not invoked:
+				invoked = self.who_spoke_last(user_lc, include_self=include_self)
+			if not invoked and self.default and user_agent and user_lc != self.default.lower() and user_agent["type"] == "person":
+				invoked = [self.default]
+
+		self.add(message)
+		logger.debug("route %r: %r", user, invoked)
+		return invoked
+
+	def matcher(self, exclude=None, at=False):
+		""" a compiled regexp to find the first agent named, or @mentioned, other than exclude """
+		key = (exclude, at)
+		matcher = self.matchers.get(key)
+		if matcher is None:
+			names = sorted(name for name in self.agents if name != exclude)
+			if not names:
+				matcher = self.matchers[key] = False
+				return matcher
+			alternatives = "|".join(map(re.escape, names))
+			if at:
+				pattern = r'(?<!\w)@(' + alternatives + r')\b'
+			else:
+				pattern = r'\b(' + alternatives + r')\b'
+			matcher = self.matchers[key] = re.compile(pattern, re.IGNORECASE)
+		return matcher
+
+	def who_is_named(self, content, user_lc, include_self=True, at=False):
+		""" check who is named first in the message """
+		matcher = self.matcher(exclude=None if include_self else user_lc, at=at)
+		match = matcher and matcher.search(content)
+		if not match:
+			return []
+		return [match.group(1).lower()]
+
+	def who_spoke_last(self, user_lc, include_self=False):
+		""" check who else spoke most recently """
+		for speaker_lc in reversed(self.speakers):
+			if (include_self or speaker_lc != user_lc) and self.agents[speaker_lc]["type"] != "tool":
+				return [self.speakers[speaker_lc]]
+		return []
 
 
 class ConductorOptions: # pylint: disable=too-few-public-methods
 	""" the options for the Conductor class """
 	exts = ()
+	agents = DEFAULT_AGENTS
+	default = None
+	command = None
+	workers = 4
+	max_count = 4
+	settle = 0.5
+
+
+Job = namedtuple("Job", "room offset message agents")
+
+SETTLED = "settled"
 
 
 class Conductor:
 	""" decide which agent/s should respond to a message and invoke them """
 
-	def __init__(self, opts, watch_log):
+	def __init__(self, opts, watch_log=None, changes=None, invoke=None):
 		""" Initialize the Conductor object """
 		self.opts = opts
 		self.watch_log = watch_log
-		self.tail = atail.AsyncTail(filename=self.watch_log, follow=True, rewind=True).run()
+		self.changes = changes or awatch.changes_from_log(self.watch_log)
+		self.invoke = invoke or self.run_command
+		self.agents = {agent.lower(): {"name": agent, "type": "ai"} for agent in opts.agents or DEFAULT_AGENTS}
+		self.positions = {}
+		self.routers = {}
+		self.counts = {}
+		self.pending = {}
+		self.ready = asyncio.Queue()
+		self.events = asyncio.Queue()
+		self.settle_timers = {}
 
 	async def run(self):
 		""" watch bb chat files, and invoke agents to reply to them where appropriate """
-		# TODO factor this with bb2html
 		logger.debug("opts: %s", self.opts)
-		async for line in self.tail:
-			logger.debug("line from tail: %s", line)
-			bb_file, change_type, old_size, new_size = line.rstrip("\n").split("\t")
-			change_type = Change(int(change_type))
-			old_size = int(old_size) if old_size != "" else None
-			new_size = int(new_size) if new_size != "" else None
-			if not bb_file.endswith(self.opts.exts):
-				continue
-			html_file = str(Path(bb_file).with_suffix(".html"))
-			if change_type == Change.deleted:
-				Path(html_file).unlink(missing_ok=True)
-				continue
-			async for row in self.file_changed(bb_file, html_file, old_size, new_size):
-				yield row
-
-	async def file_changed(self, bb_file, html_file, old_size, new_size):
-		""" check which agent to invoke, if any, and invoke it """
-		pass
-
-#		# assume the file was appended to ...
-#		html_file_mode = "a"
-#
-#		# ... unless the file has shrunk
-#		if old_size and new_size < old_size:
-#			logger.warning("bb file was truncated: %s from %s to %s", bb_file, old_size, new_size)
-#			html_file_mode = "w"
-#
-#		with open(bb_file, "r", encoding="utf-8") as bb:
-#			with open(html_file, html_file_mode, encoding="utf-8") as html:
-#				html_file_size = html.tell()
-#				if old_size and html_file_size:
-#					bb.seek(old_size)
-#				for message in chat.lines_to_messages(bb):
-#					print(chat.message_to_html(message), file=html)
-#				row = [html_file]
-#				yield row
+		workers = [asyncio.create_task(self.worker()) for _ in range(self.opts.workers)]
+		pump = asyncio.create_task(self.pump())
+		try:
+			while (event := await self.events.get()) is not None:
+				if isinstance(event, Exception):
+					raise event
+				logger.debug("change: %s", event)
+				bb_file, change_type, old_size, new_size = event
+				if not bb_file.endswith(self.opts.exts):
+					continue
+				if change_type == Change.deleted:
+					self.forget(bb_file)
+					continue
+				async for row in self.file_changed(bb_file, old_size, new_size, settled=change_type == SETTLED):
+					yield row
+		finally:
+			pump.cancel()
+			for timer in self.settle_timers.values():
+				timer.cancel()
+			for task in workers:
+				task.cancel()
+
+	async def pump(self):
+		""" pass the change events to the event queue, which also gets settled events for rooms """
+		try:
+			async for change in self.changes:
+				self.events.put_nowait(change)
+		except Exception as e:  # pylint: disable=broad-except
+			self.events.put_nowait(e)
+		else:
+			self.events.put_nowait(None)
+
+	def settle_later(self, bb_file, size):
+		""" queue a settled event for a room, if it doesn't change again for a while """
+		self.cancel_settle(bb_file)
+		loop = asyncio.get_running_loop()
+		self.settle_timers[bb_file] = loop.call_later(self.opts.settle, self.events.put_nowait, (bb_file, SETTLED, None, size))
+
+	def cancel_settle(self, bb_file):
+		""" cancel a room's settled event """
+		timer = self.settle_timers.pop(bb_file, None)
+		if timer:
+			timer.cancel()
+
+	def forget(self, bb_file):
+		""" forget what we know about a room """
+		self.cancel_settle(bb_file)
+		self.positions.pop(bb_file, None)
+		self.routers.pop(bb_file, None)
+		self.counts.pop(bb_file, None)
+
+	async def file_changed(self, bb_file, old_size, new_size, settled=False):
+		""" read the new messages, check which agent to invoke, if any, and queue a job to invoke it
+
+		The last message might still be being written, so we wait until the
+		next message starts, or the room is quiet for the settle time.
+		"""
+		start = self.positions.get(bb_file, old_size or 0)
+		if new_size is None:
+			return
+		if new_size < start:
+			# the room was truncated or rewritten, so don't respond to the old messages again
+			logger.info("bb file shrank: %s from %s to %s", bb_file, start, new_size)
+			self.forget(bb_file)
+			self.positions[bb_file] = new_size
+			return
+		if new_size == start:
+			# already handled this one
+			return
+
+		router = self.routers.get(bb_file)
+		if router is None:
+			router = self.routers[bb_file] = RoomRouter(self.agents, default=self.opts.default)
+			for _offset, message in (await asyncio.to_thread(read_messages, bb_file, 0, start))[0]:
+				router.add(message)
+		entries, end = await asyncio.to_thread(read_messages, bb_file, start, new_size)
+		if entries and not settled and self.opts.settle:
+			# hold the last message until it is complete
+			end, _message = entries.pop()
+			self.settle_later(bb_file, new_size)
+		else:
+			self.cancel_settle(bb_file)
+		self.positions[bb_file] = end
+		if not entries:
+			return
+
+		# respond to the latest message only, as the response will follow it
+		for _offset, message in entries[:-1]:
+			router.add(message)
+		message = entries[-1][1]
+
+		# limit how many times agents can respond to each other without a human message
+		user = message.get("user")
+		count = self.counts.get(bb_file, 0)
+		if user and user.lower() in self.agents:
+			count = self.counts[bb_file] = count + 1
+		elif user:
+			count = self.counts[bb_file] = 0
+		if count >= self.opts.max_count:
+			logger.info("not responding in %s, after %d agent responses", bb_file, count)
+			router.add(message)
+			return
+
+		# only agents can respond; the router may pick a person who spoke last
+		who = router.route(message)
+		who = [self.agents[agent.lower()]["name"] for agent in who if agent.lower() in self.agents]
+		logger.debug("who should respond to %s: %r", bb_file, who)
+		if not who:
+			return
+		self.enqueue(Job(bb_file, end, message, who))
+		yield [bb_file, end, *who]
+
+	def enqueue(self, job):
+		""" queue a job, replacing any job not yet started for the same agents in the room """
+		jobs = self.pending.get(job.room)
+		if jobs is None:
+			jobs = self.pending[job.room] = deque()
+			self.ready.put_nowait(job.room)
+		for i, old in enumerate(jobs):
+			if old.agents == job.agents:
+				del jobs[i]
+				break
+		jobs.append(job)
+
+	async def worker(self):
+		""" run queued jobs, one room at a time, so jobs for each room run in order """
+		while True:
+			room = await self.ready.get()
+			jobs = self.pending[room]
+			job = jobs.popleft()
+			try:
+				await self.invoke(job)
+			except Exception as e:  # pylint: disable=broad-except
+				logger.exception("job failed: %r: %r", job, e)
+			finally:
+				if jobs:
+					self.ready.put_nowait(room)
+				else:
+					del self.pending[room]
+
+	async def run_command(self, job):
+		""" invoke agents by running the configured command, with {file} and {agent} filled in """
+		if not self.opts.command:
+			return
+		for agent in job.agents:
+			args = [arg.format(file=job.room, agent=agent) for arg in shlex.split(self.opts.command)]
+			logger.info("running: %r", args)
+			proc = await asyncio.create_subprocess_exec(*args)
+			status = await proc.wait()
+			if status:
+				logger.warning("command failed with status %r: %r", status, args)
+
+
+def read_messages(bb_file, start, end):
+	""" read the messages that start between two offsets, as (offset, message) pairs, and the offset after the lines read
+
+	Continuation lines at the start belong to a message we already handled,
+	so they are skipped.
+	"""
+	with open(bb_file, "rb") as f:
+		f.seek(start)
+		data = f.read(end - start)
+	data = data[:data.rfind(b"\n")+1]
+	groups = []
+	narrative = False
+	pos = start
+	for line in data.splitlines(keepends=True):
+		if line.rstrip(b"\r\n"):
+			user, _content = chat.split_message_line(line.decode("utf-8", errors="replace"))
+			if user != chat.USER_CONTINUED and not (narrative and user == chat.USER_NARRATIVE):
+				groups.append((pos, []))
+				narrative = user == chat.USER_NARRATIVE
+		if groups:
+			groups[-1][1].append(line)
+		pos += len(line)
+	entries = [(offset, next(chat.lines_to_messages(lines))) for offset, lines in groups]
+	return entries, start + len(data)
+
 
 async def conductor_main(opts, watch_log, out=sys.stdout):
 	""" Main function """
-	conductor = Conductor(opts=opts, watch_log=watch_log)
+	changes = awatch.subscribe_changes(watch_log, opts.paths, awatch.watcher_options(exts=opts.exts, coalesce=opts.coalesce), opts.changes_log)
+	conductor = Conductor(opts=opts, changes=changes)
 	async for row in conductor.run():
 		print(*row, sep="\t", file=out)
+		out.flush()
 
 
 def get_opts():
@@ -206,6 +415,15 @@ def get_opts():
 	parser = argparse.ArgumentParser(description="conductor: decide which agent/s should respond to the chat and invoke them", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 	parser.add_argument('-w', '--watch-log', default="/dev/stdin", help="the file where changes are logged")
 	parser.add_argument('-x', '--extension', nargs="*", default=("bb",), help="the file extensions to process")
+	parser.add_argument('-p', '--paths', nargs="*", help="watch these paths in this process, instead of reading the changes log")
+	parser.add_argument('-o', '--changes-log', type=argparse.FileType("a"), help="with --paths, also log the changes to this file")
+	parser.add_argument('-c', '--coalesce', type=float, default=0, help="with --paths, merge changes to each file within this many seconds")
+	parser.add_argument('-a', '--agents', nargs="*", default=DEFAULT_AGENTS, help="the names of AI agents that can be invoked")
+	parser.add_argument('-D', '--default', help="the agent to respond when no one else should")
+	parser.add_argument('-C', '--command', help="command to invoke an agent, with {file} and {agent} placeholders")
+	parser.add_argument('-j', '--workers', type=int, default=4, help="number of agent jobs to run at once")
+	parser.add_argument('-m', '--max-count', type=int, default=4, help="maximum agent responses in a row, without a human message")
+	parser.add_argument('-s', '--settle', type=float, default=0.5, help="seconds to wait for the last message to be complete, unless the next one starts")
 	ucm.add_logging_options(parser)
 	opts = parser.parse_args()
 	return opts
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+""" llm_load.py: drive simulated chat rooms through the conductor and ally_chat, usually with core/llm_mock.py, and report turn latency """
+
+import sys
+import argparse
+import asyncio
+import logging
+import random
+import time
+import tempfile
+from pathlib import Path
+
+import ucm
+import chat
+import awatch
+import conductor
+
+
+logger = logging.getLogger(__name__)
+
+AGENT = "Ally"
+COMMAND = "ally_chat.py -f {file}"
+POLL = 0.05
+WATCH_START = 0.5
+
+
+def percentile(values, p):
+	""" the p-th percentile of sorted values, by nearest rank """
+	if not values:
+		return float("nan")
+	return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+def find_reply(room, offset, agent):
+	""" whether the agent has replied in a room after an offset """
+	with open(room, "rb") as f:
+		f.seek(offset)
+		lines = f.read().splitlines(keepends=True)
+	return any(message.get("user") == agent for message in chat.lines_to_messages(lines))
+
+
+async def run_room(room, opts, seed, latencies, errors):
+	""" run the turns of one room: a user message, then wait for the agent's reply, as the conductor invokes it """
+	rng = random.Random(seed)
+	for i in range(opts.turns):
+		if opts.think:
+			await asyncio.sleep(rng.expovariate(1 / opts.think))
+		user_message = {"user": f"User{seed}", "content": f"Message {i}, @{opts.agent} what do you think?\n"}
+		with open(room, "ab") as f:
+			f.write((chat.message_to_text(user_message) + "\n").encode("utf-8"))
+			offset = f.tell()
+		start = time.perf_counter()
+		while not find_reply(room, offset, opts.agent):
+			if time.perf_counter() - start > opts.timeout:
+				logger.warning("%s: no reply to turn %d", room, i)
+				errors.append((room, i))
+				break
+			await asyncio.sleep(POLL)
+		else:
+			latencies.append(time.perf_counter() - start)
+
+
+async def run_conductor(the_conductor):
+	""" run the conductor, logging the jobs it dispatches """
+	async for row in the_conductor.run():
+		logger.info("job: %r", row)
+
+
+async def llm_load(opts, out=sys.stdout):
+	""" run the simulated rooms concurrently under a conductor, and report the turn latencies """
+	latencies = []
+	errors = []
+	with tempfile.TemporaryDirectory(prefix="llm_load.") as rooms_dir:
+		rooms_dir = Path(opts.rooms_dir or rooms_dir).resolve()
+		rooms_dir.mkdir(parents=True, exist_ok=True)
+		rooms = [rooms_dir/f"room{i}.bb" for i in range(opts.rooms)]
+		for room in rooms:
+			room.write_bytes(b"")
+
+		conductor_opts = conductor.ConductorOptions()
+		conductor_opts.exts = (".bb",)
+		conductor_opts.agents = [opts.agent]
+		conductor_opts.command = opts.command
+		conductor_opts.workers = opts.workers
+		conductor_opts.settle = opts.settle
+		changes = awatch.subscribe_changes(paths=[str(rooms_dir)], opts=awatch.watcher_options(exts=(".bb",)))
+		the_conductor = conductor.Conductor(conductor_opts, changes=changes)
+		task = asyncio.create_task(run_conductor(the_conductor))
+		await asyncio.sleep(WATCH_START)  # let the watcher start
+
+		start = time.perf_counter()
+		try:
+			await asyncio.gather(*(run_room(room, opts, opts.seed + i, latencies, errors) for i, room in enumerate(rooms)))
+			elapsed = time.perf_counter() - start
+			# let the last agent commands exit
+			deadline = time.perf_counter() + opts.timeout
+			while the_conductor.pending and time.perf_counter() < deadline:
+				await asyncio.sleep(POLL)
+		finally:
+			task.cancel()
+
+	latencies.sort()
+	print("rooms", "turns", "errors", "p50", "p90", "p99", "max", "turns/s", sep="\t", file=out)
+	print(opts.rooms, len(latencies), len(errors), *(f"{percentile(latencies, p):.3f}" for p in (50, 90, 99, 100)), f"{len(latencies) / elapsed:.2f}", sep="\t", file=out)
+	return len(errors)
+
+
+def get_opts():
+	""" Get the command line options """
+	parser = argparse.ArgumentParser(description="llm_load: load test the chat stack with simulated rooms, through the conductor and ally_chat", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('-n', '--rooms', type=int, default=10, help="number of rooms, each with one user")
+	parser.add_argument('-t', '--turns', type=int, default=10, help="turns per room")
+	parser.add_argument('-a', '--agent', default=AGENT, help="the agent to talk to; a local agent uses the llm_llama port, which core/llm_mock.py can serve")
+	parser.add_argument('-C', '--command', default=COMMAND, help="command to invoke an agent, with {file} and {agent} placeholders, as for the conductor")
+	parser.add_argument('-j', '--workers', type=int, default=4, help="number of agent jobs to run at once")
+	parser.add_argument('-s', '--settle', type=float, default=0.5, help="seconds for the conductor to wait for the last message to be complete")
+	parser.add_argument('-w', '--think', type=float, default=0, help="mean seconds for a user to think between turns")
+	parser.add_argument('-T', '--timeout', type=float, default=60, help="seconds to wait for each reply")
+	parser.add_argument('-D', '--rooms-dir', help="keep the rooms in this directory")
+	parser.add_argument('-S', '--seed', type=int, default=0, help="random seed")
+	ucm.add_logging_options(parser)
+	opts = parser.parse_args()
+	return opts
+
+
+def main():
+	""" Main function """
+	opts = get_opts()
+	ucm.setup_logging(opts)
+	errors = asyncio.run(llm_load(opts))
+	sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+	main()
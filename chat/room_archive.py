@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+""" room_archive.py: roll old messages from a room into compressed, immutable segments, and read the full history back """
+
+import os
+import sys
+import logging
+import time
+import gzip
+import zlib
+from pathlib import Path
+from collections import namedtuple
+
+import argh
+
+import chat
+
+
+logger = logging.getLogger(__name__)
+
+KEEP_BYTES = 256 * 1024
+MIN_SEGMENT_BYTES = 1024 * 1024
+READ_BLOCK_SIZE = 65536
+INDEX_NAME = "index.tsv"
+CUT_NAME = "cut.tsv"
+BB_CONTINUATION_STARTS = (b"\t", b" ", b"\r", b"\n")
+
+Segment = namedtuple("Segment", "name offset size messages crc ino")
+
+
+def archive_dir(room):
+	""" The hidden directory holding a room's segments and index """
+	room = Path(room)
+	return room.parent / f".{room.name}.archive"
+
+
+def room_ino(room):
+	""" The inode of a room file, which compaction keeps, or None if there is no room """
+	try:
+		return os.stat(room).st_ino
+	except FileNotFoundError:
+		return None
+
+
+def read_index(room, check=True):
+	""" Read a room's segment index, oldest first.
+	With check, an index left by another room at the same path, e.g. before the room was rotated, is ignored. """
+	try:
+		with open(archive_dir(room) / INDEX_NAME, encoding="utf-8") as f:
+			rows = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+	except FileNotFoundError:
+		return []
+	segments = [Segment(name, *map(int, numbers)) for name, *numbers in rows]
+	if check and segments and segments[-1].ino != room_ino(room):
+		logger.debug("ignoring the archive of an older room: %s", room)
+		return []
+	return segments
+
+
+def write_atomic(path, text):
+	""" Write a small file atomically """
+	temp = path.with_suffix(f".{os.getpid()}.tmp")
+	with open(temp, "w", encoding="utf-8") as f:
+		f.write(text)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(temp, path)
+
+
+def write_index(room, segments):
+	""" Write a room's segment index atomically """
+	write_atomic(archive_dir(room) / INDEX_NAME, "".join("\t".join(map(str, segment)) + "\n" for segment in segments))
+
+
+def retire_archive(room):
+	""" Move aside an archive left by an older room at the same path, so that compaction starts a new one """
+	directory = archive_dir(room)
+	if read_index(room) or not read_index(room, check=False):
+		return
+	old = directory.with_name(f"{directory.name}.{time.strftime('%Y%m%d-%H%M%S')}")
+	logger.warning("moving the archive of an older room to %s", old)
+	directory.rename(old)
+
+
+def archived_size(room):
+	""" The number of bytes of history in a room's segments """
+	segments = read_index(room)
+	if not segments:
+		return 0
+	last = segments[-1]
+	return last.offset + last.size
+
+
+def cut_offset(data, limit):
+	""" The offset of the last message start at or before limit, or 0 """
+	pos = data.rfind(b"\n", 0, limit)
+	while pos >= 0:
+		if pos + 1 < len(data) and not data.startswith(BB_CONTINUATION_STARTS, pos + 1):
+			return pos + 1
+		pos = data.rfind(b"\n", 0, pos)
+	return 0
+
+
+def count_messages(data):
+	""" Count the messages in some bb data """
+	lines = data.splitlines(keepends=True)
+	return sum(1 for _ in chat.lines_to_messages(lines))
+
+
+def recover(room, f, segments):
+	""" Finish a compaction that was interrupted after the index was written, before or while the room was cut """
+	if not segments:
+		return
+	last = segments[-1]
+	try:
+		cut, pos = map(int, (archive_dir(room) / CUT_NAME).read_text(encoding="utf-8").split())
+	except FileNotFoundError:
+		cut, pos = last.size, None
+	if cut != last.size:
+		logger.error("cut record for %s does not match its index, ignoring it: %d != %d", room, cut, last.size)
+		return
+	if pos is None:
+		head = pread_all(f.fileno(), last.size, 0)
+		if len(head) != last.size or zlib.crc32(head) != last.crc:
+			return
+	logger.warning("finishing interrupted compaction of %s", room)
+	cut_room(room, f, cut, pos)
+
+
+def pread_all(fd, size, offset):
+	""" Read size bytes from offset, or up to the end of the file """
+	blocks = []
+	while size > 0:
+		block = os.pread(fd, size, offset)
+		if not block:
+			break
+		blocks.append(block)
+		size -= len(block)
+		offset += len(block)
+	return b"".join(blocks)
+
+
+def cut_room(room, f, cut, pos=None):
+	""" Remove the first cut bytes from the room, in place, so writers and tailers keep the same file.
+
+	Each block is moved back by cut bytes, and the position is recorded
+	after it is synced, so recover() can go on from there after a crash.
+	Blocks are no bigger than cut, so the ones yet to move are never
+	overwritten, and a block can safely be moved twice.
+	"""
+	fd = f.fileno()
+	cut_file = archive_dir(room) / CUT_NAME
+	if pos is None:
+		pos = cut
+		write_atomic(cut_file, f"{cut}\t{pos}\n")
+	block_size = min(READ_BLOCK_SIZE, cut)
+	while block := os.pread(fd, block_size, pos):
+		os.pwrite(fd, block, pos - cut)
+		pos += len(block)
+		os.fsync(fd)
+		write_atomic(cut_file, f"{cut}\t{pos}\n")
+	os.ftruncate(fd, pos - cut)
+	os.fsync(fd)
+	cut_file.unlink()
+
+
+def compact(room, keep=KEEP_BYTES, min_segment=MIN_SEGMENT_BYTES, level=9):
+	""" Move old messages from a room into a new segment, keeping at least keep bytes of recent messages live """
+	room = Path(room)
+	with open(room, "r+b") as f:
+		with chat.file_lock(f):
+			retire_archive(room)
+			segments = read_index(room)
+			recover(room, f, segments)
+			size = os.fstat(f.fileno()).st_size
+			if size - keep < min_segment:
+				return None
+			data = pread_all(f.fileno(), size - keep + 1, 0)
+			cut = cut_offset(data, size - keep)
+			if cut < min_segment:
+				return None
+			data = data[:cut]
+
+			offset = segments[-1].offset + segments[-1].size if segments else 0
+			segment = Segment(f"{offset:016d}.bb.gz", offset, cut, count_messages(data), zlib.crc32(data), os.fstat(f.fileno()).st_ino)
+			directory = archive_dir(room)
+			directory.mkdir(exist_ok=True)
+			path = directory / segment.name
+			temp = path.with_suffix(f".{os.getpid()}.tmp")
+			with gzip.open(temp, "wb", compresslevel=level) as gz:
+				gz.write(data)
+			with open(temp, "rb") as tf:
+				os.fsync(tf.fileno())
+			os.replace(temp, path)
+
+			# After the index is written, recover() can finish the cut if we crash.
+			write_index(room, segments + [segment])
+			cut_room(room, f, cut)
+
+	logger.info("compacted %s: %d bytes, %d messages into %s", room, segment.size, segment.messages, segment.name)
+	return segment
+
+
+def history_blocks(room, start=0, end=None, block_size=READ_BLOCK_SIZE, live=True):
+	""" Yield the full history of a room as blocks of bytes, from segments then the live file, from offset start to end """
+	room = Path(room)
+	segments = read_index(room)
+	directory = archive_dir(room)
+	for segment in segments:
+		if start >= segment.offset + segment.size:
+			continue
+		if end is not None and end <= segment.offset:
+			return
+		remaining = segment.size if end is None else min(segment.size, end - segment.offset)
+		with gzip.open(directory / segment.name, "rb") as gz:
+			skip = max(0, start - segment.offset)
+			while skip:
+				skipped = len(gz.read(min(skip, block_size)))
+				if not skipped:
+					break
+				skip -= skipped
+			remaining -= max(0, start - segment.offset)
+			while remaining > 0 and (block := gz.read(min(block_size, remaining))):
+				remaining -= len(block)
+				yield block
+	if not live:
+		return
+	base = segments[-1].offset + segments[-1].size if segments else 0
+	pos = max(start, base)
+	try:
+		with open(room, "rb") as f:
+			while end is None or pos < end:
+				block = os.pread(f.fileno(), block_size if end is None else min(block_size, end - pos), pos - base)
+				if archived_size(room) != base:
+					# compacted while we read, so the live file moved; go on from the archive
+					yield from history_blocks(room, start=pos, end=end, block_size=block_size, live=live)
+					return
+				if not block:
+					break
+				pos += len(block)
+				yield block
+	except FileNotFoundError:
+		pass
+
+
+def history_lines(room, start=0):
+	""" Yield the full history of a room as lines of bytes, see history_blocks """
+	partial = b""
+	for block in history_blocks(room, start=start):
+		lines = (partial + block).split(b"\n")
+		partial = lines.pop()
+		for line in lines:
+			yield line + b"\n"
+	if partial:
+		yield partial
+
+
+@argh.named("compact")
+@argh.arg("rooms", nargs="+", help="room files to compact")
+@argh.arg("-k", "--keep", help="bytes of recent messages to keep in the live file")
+@argh.arg("-m", "--min-segment", help="don't make segments smaller than this")
+def compact_rooms(rooms, keep=KEEP_BYTES, min_segment=MIN_SEGMENT_BYTES):
+	""" Compact rooms, moving old messages into compressed segments """
+	for room in rooms:
+		segment = compact(room, keep=keep, min_segment=min_segment)
+		if segment:
+			print(room, segment.name, segment.size, segment.messages, sep="\t")
+
+
+@argh.arg("room", help="room file")
+@argh.arg("-s", "--start", help="offset in the full history to start from")
+def cat(room, start=0):
+	""" Write the full history of a room, including archived segments """
+	for block in history_blocks(room, start=start):
+		sys.stdout.buffer.write(block)
+
+
+@argh.arg("room", help="room file")
+def index(room):
+	""" Show a room's segment index """
+	for segment in read_index(room):
+		print(*segment, sep="\t")
+
+
+if __name__ == "__main__":
+	argh.dispatch_commands([compact_rooms, cat, index])
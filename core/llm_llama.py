@@ -12,13 +12,10 @@ import re
 
 import argh
 import inotify.adapters
-import torch
 import yaml
 
 os.environ["TRANSFORMERS_OFFLINE"] = "1"
 
-import transformers  # pylint: disable=wrong-import-position
-
 logger = logging.getLogger(__name__)
 
 # TODO move to a library, allemande.py?
@@ -39,6 +36,9 @@ models_dir = Path(os.environ["ALLEMANDE_MODELS"])/"llm"
 
 def load_model(model_path, device_map="auto"):
 	""" Load a model """
+	# torch and transformers are imported here and in gen, so llm_mock can use the serving loop without them
+	import torch  # pylint: disable=import-outside-toplevel
+	import transformers  # pylint: disable=import-outside-toplevel
 	model_path = str(model_path)
 	model = transformers.LlamaForCausalLM.from_pretrained(
 		model_path,
@@ -62,6 +62,8 @@ def gen(config, input_text, *_args, model=None, **_kwargs):
 	if config is None:
 		config = {}
 
+	import torch  # pylint: disable=import-outside-toplevel
+
 	if _args:
 		logger.warning("gen: ignoring args: %s", _args)
 	if _kwargs:
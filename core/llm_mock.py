@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+""" allemande - core mock llm module, a drop-in for llm_llama to load test without a GPU """
+
+import sys
+import logging
+from functools import partial
+
+import argh
+
+import llm_llama
+import mock_llm
+
+logger = logging.getLogger(__name__)
+
+
+def gen(config, input_text, *_args, model=None, **_kwargs):
+	""" Generate text from the mock model. """
+	if config is None:
+		config = {}
+	new_text = model.complete(input_text, max_tokens=config.get("max_new_tokens"))
+	if new_text:
+		new_text = " " + new_text
+	response = {
+		"new.txt": new_text,
+		"full.txt": input_text + new_text,
+	}
+	return response
+
+
+@argh.arg("-s", "--spec", help="mock LLM settings, e.g. latency=0.5,rate=50,error=0.01; default $LLM_MOCK")
+def main(ports=str(llm_llama.ports_dir), spec=None, verbose=False, debug=False):
+	""" main function: serve the llm_llama ports with llm_llama's loop, so that clients don't need to change """
+	llm_llama.setup_logging(verbose, debug)
+	model = mock_llm.MockLLM.from_spec(spec) if spec else mock_llm.get_mock()
+	fn = partial(gen, model=model)
+	llm_llama.serve_requests(ports, fn)
+
+
+if __name__ == "__main__":
+	try:
+		argh.dispatch_command(main)
+	except KeyboardInterrupt:
+		logger.info("interrupted")
+		sys.exit(1)
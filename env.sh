@@ -30,7 +30,7 @@ fi
 
 PYTHON=$(which python3)
 
-for dir in python text www chat anthropic google llm scrape tools; do
+for dir in python text www chat anthropic google llm scrape tools sys; do
 	PYTHONPATH=${PYTHONPATH:-}:$ALLEMANDE_HOME/$dir
 done
 
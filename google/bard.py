@@ -17,6 +17,27 @@ import requests
 import argh
 
 
+HEADERS = {
+    "Host": "bard.google.com",
+    "X-Same-Domain": "1",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/91.0.4472.114 Safari/537.36",
+    "Content-Type": "application/x-www-form-urlencoded;charset=UTF-8",
+    "Origin": "https://bard.google.com",
+    "Referer": "https://bard.google.com/",
+}
+
+
+def new_session():
+    """
+    Create a requests.Session with the headers and cookie that Bard needs
+    """
+    session = requests.Session()
+    session.headers = dict(HEADERS)
+    session.cookies.set("__Secure-1PSID", os.environ["_BARD_API_KEY"])
+    return session
+
+
 class Bard:
     def __init__(self, timeout=30, proxies=None, session=None, state=None, state_file=None, auto_save=None):
         """
@@ -39,23 +60,11 @@ class Bard:
         if auto_save is None:
             auto_save = bool(state_file)
         self.auto_save = auto_save
-        headers = {
-            "Host": "bard.google.com",
-            "X-Same-Domain": "1",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) "
-            "Chrome/91.0.4472.114 Safari/537.36",
-            "Content-Type": "application/x-www-form-urlencoded;charset=UTF-8",
-            "Origin": "https://bard.google.com",
-            "Referer": "https://bard.google.com/",
-        }
         self._reqid = int("".join(random.choices(string.digits, k=4)))
 
         if session is None:
-            self.session = requests.Session()
-            self.session.headers = headers
-            self.session.cookies.set("__Secure-1PSID", os.environ["_BARD_API_KEY"])
-        else:
-            self.session = session
+            session = new_session()
+        self.session = session
 
         if state_file:
             try:
@@ -14,15 +14,26 @@ from math import inf
 import time
 import random
 from pathlib import Path
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import json
+import hashlib
+import sqlite3
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
 
 import argh
 
+import requests
 import openai
 import tiktoken
+import anthropic
 
 import tab
 import claude
+import bard
 from bard import Bard
+import mock_llm
 from slugify import slugify
 
 # import json
@@ -34,7 +45,26 @@ logger = logging.getLogger(__name__)
 LOGDIR = Path(os.environ["HOME"])/"llm.log"
 LOGFILE_NAME_MAX_LEN = 100
 RETRIES = 20
-BAD_ERRORS_NO_RETRY = "maximum context length", "context_length_exceeded"
+BAD_ERRORS_NO_RETRY = "maximum context length", "context_length_exceeded", "response not in cache"
+RETRY_DEADLINE = 600
+RETRY_MAX_SLEEP = 60
+FATAL, RATE_LIMIT, TRANSIENT = "fatal", "rate limit", "transient"
+HEDGE_DELAY = 5.0
+RACE_WORKERS = 16
+RACE_LATENCIES = 100
+JOBS = 1
+BATCH_JOBS = 4
+CACHE_FILE = Path(os.environ.get("LLM_CACHE_FILE", Path(os.environ["HOME"])/"llm.cache.sqlite"))
+CACHE_MODES = "", "on", "only", "refresh"
+CACHE_MAX_ENTRIES = 100000
+CACHE_EVICT_EVERY = 100
+POOL_SIZE = int(os.environ.get("LLM_POOL_SIZE", 10))
+POOL_CHECK_TIMEOUT = 10
+POOL_IDLE_CHECK = 300
+ANTHROPIC_API_URL = os.environ.get("ANTHROPIC_API_URL", "https://api.anthropic.com")
+BARD_URL = "https://bard.google.com/"
+TOKEN_COUNT_CACHE_SIZE = 100000
+COUNT_BATCH_SIZE = 1000
 
 models = {
 	"gpt-3.5-turbo": {
@@ -75,7 +105,12 @@ models = {
 	"bard": {
 		"abbrev": "b",
 		"description": "Google Bard is a large language model (LLM) chatbot developed by Google AI. It is trained on a massive dataset of text and code, and can generate text, translate languages, write different kinds of creative content, and answer your questions in an informative way.",
-	}
+	},
+	"mock": {
+		"abbrev": "m",
+		"description": "A local mock LLM for load testing, with latency, streaming and errors configured by $LLM_MOCK, e.g. latency=0.5,rate=50,rate_limit=0.05",
+		"cost": 0.0,
+	},
 #	"gpt-3.5-turbo-0301": {
 #		"description": "Snapshot of gpt-3.5-turbo from March 1st 2023. Unlike gpt-3.5-turbo, this model will not receive updates, and will only be supported for a three month period ending on June 1st 2023.",
 #		"cost": 0.002,
@@ -160,6 +195,15 @@ def get_model_by_abbrev(model):
 	return model
 
 
+def env_cache_mode():
+	""" The default cache mode from $LLM_CACHE; an unknown mode is a warning, and turns the cache off. """
+	mode = os.environ.get("LLM_CACHE", "")
+	if mode not in CACHE_MODES:
+		logger.warning("unknown cache mode in $LLM_CACHE: %r, not using the cache", mode)
+		return ""
+	return mode
+
+
 class AutoInit:  # pylint: disable=too-few-public-methods
 	""" Automatically set attributes from kwargs. """
 	def __init__(self, **kwargs):
@@ -176,7 +220,13 @@ class Options(AutoInit):  # pylint: disable=too-few-public-methods
 	indent: str = "\t"
 	state_file: Optional[str] = None
 	auto_save: bool = False
+	cache: str = env_cache_mode()
+	stream: bool = False
 	def __init__(self, **kwargs):
+		if kwargs.get("cache") is None:
+			kwargs.pop("cache", None)
+		elif kwargs["cache"] not in CACHE_MODES:
+			raise ValueError(f"unknown cache mode: {kwargs['cache']}")
 		if kwargs.get("model"):
 			kwargs["model"] = get_model_by_abbrev(kwargs["model"])
 		if kwargs.get("state_file") and kwargs.get("auto_save") is None:
@@ -184,23 +234,212 @@ class Options(AutoInit):  # pylint: disable=too-few-public-methods
 		super().__init__(**kwargs)
 
 
-opts: Options = Options()
+class ThreadOptions:  # pylint: disable=too-few-public-methods
+	""" The options for the current thread if it has its own, otherwise the global options. """
+	def __getattr__(self, name):
+		return getattr(getattr(thread_local, "opts", None) or global_opts, name)
+
+
+global_opts: Options = Options()
+thread_local = threading.local()
+opts = ThreadOptions()
 
 
 def set_opts(_opts):
 	""" Set the global options. """
-	global opts  # pylint: disable=global-statement
-	opts = Options(**_opts)
+	global global_opts  # pylint: disable=global-statement
+	global_opts = Options(**_opts)
 
 
-def chat_gpt(messages):  # 0.9, token_limit=150, top_p=1, frequency_penalty=0, presence_penalty=0, stop=["\n\n"]):
-	""" Chat with OpenAI ChatGPT models. """
+def get_opts_dict():
+	""" Get the current options as a dict. """
+	return {k: getattr(opts, k) for k in Options.__annotations__}  # pylint: disable=no-member
+
+
+def with_thread_opts(_opts, fn, *args, **kwargs):
+	""" Call a function with options for this thread only. """
+	thread_local.opts = Options(**_opts)
+	try:
+		return fn(*args, **kwargs)
+	finally:
+		thread_local.opts = None
+
+
+class ClientPool:
+	""" Keep-alive API clients, created once per process and reused. """
+	def __init__(self, pool_size=POOL_SIZE, idle_check=POOL_IDLE_CHECK):
+		self.pool_size = pool_size
+		self.idle_check = idle_check
+		self.clients = {}
+		self.used = {}
+		self.lock = threading.Lock()
+
+	def get(self, provider):
+		""" Get the client for a provider, creating it if need be, and checking it first if it was idle for a while """
+		with self.lock:
+			idle = provider in self.clients and time.time() - self.used[provider] > self.idle_check
+		if idle:
+			self.check(provider)
+		with self.lock:
+			client = self.clients.get(provider)
+			if client is None:
+				client = self.clients[provider] = self.new_client(provider)
+				logger.debug("new client for %s", provider)
+			self.used[provider] = time.time()
+		return client
+
+	def new_client(self, provider):
+		""" Create a client for a provider: an anthropic.Client, or a requests.Session """
+		if provider == "anthropic":
+			client = anthropic.Client(os.environ["ANTHROPIC_API_KEY"], api_url=ANTHROPIC_API_URL)
+			self.mount(client._session, max_retries=client.max_connection_retries)  # pylint: disable=protected-access
+		elif provider == "openai":
+			client = requests.Session()
+			self.mount(client)
+		elif provider == "google":
+			client = bard.new_session()
+			self.mount(client)
+		else:
+			raise ValueError(f"unknown provider: {provider}")
+		return client
+
+	def mount(self, session, max_retries=0):
+		""" Size a session's connection pool """
+		adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size, max_retries=max_retries)
+		session.mount("https://", adapter)
+		session.mount("http://", adapter)
+
+	@staticmethod
+	def session_and_url(provider, client):
+		""" The requests session of a client, and the base URL of its provider """
+		if provider == "anthropic":
+			return client._session, client.api_url  # pylint: disable=protected-access
+		if provider == "openai":
+			return client, openai.api_base
+		return client, BARD_URL
+
+	def discard(self, provider):
+		""" Close and forget a provider's client, so the next call gets a new one """
+		with self.lock:
+			client = self.clients.pop(provider, None)
+		if client is not None:
+			self.session_and_url(provider, client)[0].close()
+			logger.info("discarded client for %s", provider)
+
+	def check(self, provider):
+		""" Check that a provider's client can reach its server; discard it if not """
+		with self.lock:
+			client = self.clients.get(provider)
+		if client is None:
+			return True
+		session, url = self.session_and_url(provider, client)
+		try:
+			response = session.head(url, timeout=POOL_CHECK_TIMEOUT)
+			ok = response.status_code < 500
+		except requests.RequestException as ex:
+			logger.warning("client check failed for %s: %s", provider, ex)
+			ok = False
+		if not ok:
+			self.discard(provider)
+		return ok
+
+
+def test_client_pool():
+	""" Test that ClientPool reuses connections, and discards a client that can't reach its server. """
+	import http.server  # pylint: disable=import-outside-toplevel
+	peers = []
+
+	class Handler(http.server.BaseHTTPRequestHandler):
+		""" a mock API server that records the client's address for each request """
+		protocol_version = "HTTP/1.1"
+
+		def do_GET(self):  # pylint: disable=invalid-name
+			""" record the client's address, and reply """
+			peers.append(self.client_address)
+			self.send_response(200)
+			self.send_header("Content-Length", "2")
+			self.end_headers()
+			if self.command != "HEAD":
+				self.wfile.write(b"ok")
+
+		do_HEAD = do_GET
+
+		def do_POST(self):  # pylint: disable=invalid-name
+			""" record the client's address, and reply with a chat completion """
+			peers.append(self.client_address)
+			self.rfile.read(int(self.headers["Content-Length"]))
+			body = json.dumps({"choices": [{"message": {"role": "assistant", "content": "ok"}}]}).encode()
+			self.send_response(200)
+			self.send_header("Content-Type", "application/json")
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, *args):  # pylint: disable=arguments-differ
+			pass
+
+	server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+	server.handle_error = lambda request, client_address: None
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	url = f"http://127.0.0.1:{server.server_address[1]}/"
+	api_base, api_key = openai.api_base, openai.api_key
+	openai.api_base, openai.api_key = url, "test"
+	pool = ClientPool(pool_size=2, idle_check=0)
+	try:
+		session = pool.get("openai")
+		for _ in range(5):
+			assert session.get(url, timeout=5).text == "ok"
+		assert len(set(peers)) == 1
+		assert pool.get("openai") is session
+
+		# openai calls go through the pooled session, and a discarded session is not reused
+		def ask():
+			use_openai_session(pool.get("openai"))
+			completion = openai.ChatCompletion.create(model="gpt-4", messages=[{"role": "user", "content": "hi"}])
+			assert completion["choices"][0]["message"]["content"] == "ok"
+			return peers[-1]
+		assert ask() == ask() == peers[0]
+		pool.discard("openai")
+		assert ask() != peers[0]
+		assert openai.api_requestor._thread_context.session is not session  # pylint: disable=protected-access
+		assert pool.get("openai") is not session
+		session = pool.get("openai")
+
+		server.shutdown()
+		server.server_close()
+		session.close()
+		assert pool.get("openai") is not session
+	finally:
+		openai.api_base, openai.api_key = api_base, api_key
+		server.server_close()
+
+
+client_pool = ClientPool()
+
+
+def use_openai_session(session):
+	""" Make openai use our pooled session in this thread.
+	openai keeps its own session per thread, reads openai.requestssession only when it first makes one,
+	and closes it after a few minutes; so we put ours in its place, and renew it, on each call. """
+	context = openai.api_requestor._thread_context  # pylint: disable=protected-access
+	context.session = session
+	context.session_create_time = time.time()
+
+
+def chat_gpt(messages, out=None):  # 0.9, token_limit=150, top_p=1, frequency_penalty=0, presence_penalty=0, stop=["\n\n"]):
+	""" Chat with OpenAI ChatGPT models, streaming to out if given. """
 	temperature = opts.temperature
 	token_limit = opts.token_limit
 	if temperature is None:
 		temperature = DEFAULT_TEMPERATURE
 	if token_limit is None:
 		token_limit = TOKEN_LIMIT
+	use_openai_session(client_pool.get("openai"))
+
+	if out:
+		return chat_gpt_stream(messages, out)
+
 	completion = openai.ChatCompletion.create(
 		model=opts.model,
 		messages=messages
@@ -213,13 +452,35 @@ def chat_gpt(messages):  # 0.9, token_limit=150, top_p=1, frequency_penalty=0, p
 	return output_message
 
 
-def chat_claude(messages):
-	""" Chat with Anthropic Claude models. """
+def chat_gpt_stream(messages, out):
+	""" Chat with OpenAI ChatGPT models, writing the response to out as it arrives. """
+	chunks = openai.ChatCompletion.create(
+		model=opts.model,
+		messages=messages,
+		stream=True,
+	)
+	parts = []
+	for chunk in chunks:
+		part = chunk['choices'][0]['delta'].get('content')
+		if part:
+			parts.append(part)
+			out.write(part)
+			out.flush()
+	return { "role": "assistant", "content": "".join(parts) }
+
+
+def chat_claude(messages, out=None):
+	""" Chat with Anthropic Claude models, streaming to out if given. """
 	model = opts.model
 	temperature = opts.temperature
 	token_limit = opts.token_limit
-	response = claude.chat_claude(messages, model=model, temperature=temperature, token_limit=token_limit)
-	completion = claude.response_completion(response)
+	response = claude.chat_claude(messages, model=model, temperature=temperature, token_limit=token_limit, streaming=bool(out), client=client_pool.get("anthropic"))
+	if out:
+		completion = ""
+		for data in response:
+			completion = claude.stream_completion(data, completion, out)
+	else:
+		completion = claude.response_completion(response)
 	message = { "role": "assistant", "content": completion }
 	return message
 
@@ -231,27 +492,241 @@ def chat_bard(messages):
 	# Perhaps we should save state in chat metadata.
 	if not messages or messages[-1]["role"] == "assistant":
 		raise ValueError("Bard requires a conversation ending with a user message.")
-	bard = Bard(state_file=opts.state_file, auto_save=opts.auto_save)
-	response = bard.get_answer(messages[-1]["content"])
+	bard_client = Bard(state_file=opts.state_file, auto_save=opts.auto_save, session=client_pool.get("google"))
+	response = bard_client.get_answer(messages[-1]["content"])
 	completion = response["content"]
 	message = { "role": "assistant", "content": completion }
 	return message
 
 
-def llm_chat(messages):
+def model_provider(model):
+	""" The provider of a model, for rate limiting. """
+	if model.startswith("claude"):
+		return "anthropic"
+	if model.startswith("gpt"):
+		return "openai"
+	if model.startswith("bard"):
+		return "google"
+	if model.startswith("mock"):
+		return "mock"
+	raise ValueError(f"unknown model: {model}")
+
+
+class RateLimiter:
+	""" Limit requests and tokens per minute, across threads, and pause everyone when the server asks. """
+	def __init__(self, rpm=None, tpm=None):
+		self.rpm = rpm
+		self.tpm = tpm
+		self.requests = rpm or 0
+		self.tokens = tpm or 0
+		self.time = time.monotonic()
+		self.paused_until = 0
+		self.lock = threading.Lock()
+
+	def refill(self):
+		""" Top up the allowances for the time that has passed, not counting any pause. """
+		now = time.monotonic()
+		elapsed = max(0, now - max(self.time, self.paused_until))
+		self.time = now
+		if self.rpm:
+			self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+		if self.tpm:
+			self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+		return now
+
+	def acquire(self, tokens=0):
+		""" Wait until we can make a request using this many tokens. """
+		while True:
+			with self.lock:
+				now = self.refill()
+				wait = max(0, self.paused_until - now)
+				if self.rpm and self.requests < 1:
+					wait = max(wait, (1 - self.requests) * 60 / self.rpm)
+				# a request bigger than the whole allowance goes when the allowance is full
+				if self.tpm and self.tokens < min(tokens, self.tpm):
+					wait = max(wait, (min(tokens, self.tpm) - self.tokens) * 60 / self.tpm)
+				if not wait:
+					self.requests -= 1
+					self.tokens -= tokens
+					return
+			time.sleep(wait)
+
+	def consume(self, tokens):
+		""" Count tokens used after the fact, e.g. by the response. """
+		with self.lock:
+			self.tokens -= tokens
+
+	def pause(self, seconds):
+		""" Hold all requests for a while, then resume gently from empty allowances. """
+		with self.lock:
+			self.refill()
+			self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+			self.requests = min(self.requests, 0)
+			self.tokens = min(self.tokens, 0)
+
+
+rate_limiters: dict[str, RateLimiter] = {}
+rate_limiters_lock = threading.Lock()
+
+
+def set_rate_limit(provider, rpm=None, tpm=None):
+	""" Limit the requests and tokens per minute for a provider. """
+	with rate_limiters_lock:
+		rate_limiters[provider] = RateLimiter(rpm=rpm, tpm=tpm)
+
+
+def get_rate_limiter(provider):
+	""" Get the rate limiter for a provider; by default it only pauses after rate limit errors. """
+	with rate_limiters_lock:
+		if provider not in rate_limiters:
+			rate_limiters[provider] = RateLimiter()
+		return rate_limiters[provider]
+
+
+class ResponseCache:
+	""" A persistent cache of responses, keyed on the model, messages, temperature and token limit. """
+	def __init__(self, path=CACHE_FILE, max_entries=CACHE_MAX_ENTRIES):
+		self.path = Path(path)
+		self.max_entries = max_entries
+		self.puts = 0
+		self.lock = threading.Lock()
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		self.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL, used REAL)")
+		self.db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+
+	@staticmethod
+	def key(model, messages, temperature, token_limit):
+		""" The cache key for a request """
+		request = {"model": model, "messages": messages, "temperature": temperature, "token_limit": token_limit}
+		return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+	def get(self, key):
+		""" Get a cached response, or None """
+		with self.lock:
+			row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+			if row is None:
+				return None
+			self.db.execute("UPDATE responses SET used = ? WHERE key = ?", (time.time(), key))
+		return json.loads(row[0])
+
+	def put(self, key, model, response):
+		""" Cache a response, evicting the least recently used responses now and then """
+		now = time.time()
+		with self.lock:
+			self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (key, model, json.dumps(response), now, now))
+			self.puts += 1
+		if self.puts % CACHE_EVICT_EVERY == 0:
+			self.evict()
+
+	def evict(self, max_entries=None, max_age=None):
+		""" Remove the least recently used responses beyond max_entries, and any not used for max_age seconds """
+		if max_entries is None:
+			max_entries = self.max_entries
+		with self.lock:
+			count = self.db.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used DESC LIMIT -1 OFFSET ?)", (max_entries,)).rowcount
+			if max_age is not None:
+				count += self.db.execute("DELETE FROM responses WHERE used < ?", (time.time() - max_age,)).rowcount
+		return count
+
+	def clear(self):
+		""" Remove all responses """
+		with self.lock:
+			self.db.execute("DELETE FROM responses")
+			self.db.execute("VACUUM")
+
+	def stats(self):
+		""" The number of responses and bytes cached for each model """
+		with self.lock:
+			return self.db.execute("SELECT model, COUNT(*), SUM(LENGTH(response)) FROM responses GROUP BY model ORDER BY model").fetchall()
+
+
+response_caches: dict[Path, ResponseCache] = {}
+response_caches_lock = threading.Lock()
+
+
+def get_response_cache(path=CACHE_FILE):
+	""" Get the response cache for a path, opening it once per process """
+	path = Path(path)
+	with response_caches_lock:
+		if path not in response_caches:
+			response_caches[path] = ResponseCache(path)
+		return response_caches[path]
+
+
+def llm_chat(messages, out=None):
+	""" Send a list of messages to the model, and return the response, from the cache if enabled.
+	If out is given, also write the content to out as it arrives. """
+	if not opts.cache or opts.fake:
+		return llm_chat_limited(messages, out)
+
+	cache = get_response_cache()
+	key = cache.key(opts.model, messages, opts.temperature, opts.token_limit)
+	if opts.cache != "refresh":
+		response = cache.get(key)
+		if response is not None:
+			logger.debug("llm_chat: cache hit: %s", key)
+			if out:
+				out.write(response["content"])
+				out.flush()
+			return response
+		if opts.cache == "only":
+			raise LookupError(f"response not in cache: {key}")
+	response = llm_chat_limited(messages, out)
+	cache.put(key, opts.model, response)
+	return response
+
+
+def llm_chat_limited(messages, out=None):
 	""" Send a list of messages to the model, and return the response. """
 	logger.debug("llm_chat: input: %r", messages)
 
 	model = opts.model
 
+	if opts.fake:
+		return llm_chat2(messages, out)
+
+	limiter = get_rate_limiter(model_provider(model))
+	tokens = count_tokens("".join(m["content"] for m in messages), model) if limiter.tpm else 0
+	limiter.acquire(tokens)
+	response = llm_chat2(messages, out)
+	if limiter.tpm:
+		limiter.consume(count_tokens(response["content"], model))
+	return response
+
+
+def llm_chat2(messages, out=None):
+	""" Send a list of messages to the model, and return the response, streaming to out if given. """
+	model = opts.model
+
 	if opts.fake:
 		return fake_completion
+	try:
+		return llm_chat3(messages, out)
+	except (requests.ConnectionError, openai.error.APIConnectionError):
+		# the connection may be stale, so the next try should use a new client
+		client_pool.discard(model_provider(model))
+		raise
+
+
+def llm_chat3(messages, out=None):
+	""" Send a list of messages to the model's provider, and return the response. """
+	model = opts.model
+
 	if model.startswith("claude"):
-		return chat_claude(messages)
+		return chat_claude(messages, out)
 	if model.startswith("gpt"):
-		return chat_gpt(messages)
+		return chat_gpt(messages, out)
 	if model.startswith("bard"):
-		return chat_bard(messages)
+		# Bard can't stream, so write the whole response
+		message = chat_bard(messages)
+		if out:
+			out.write(message["content"])
+			out.flush()
+		return message
+	if model.startswith("mock"):
+		return mock_llm.get_mock().chat(messages, out)
 	raise ValueError(f"unknown model: {model}")
 
 
@@ -320,6 +795,40 @@ def messages_to_lines(messages):
 	return lines
 
 
+class MessageStreamWriter:
+	""" Write a streamed message in the format of messages_to_lines, as it arrives. """
+	def __init__(self, out, role="assistant"):
+		self.out = out
+		self.role = role
+		self.started = False
+		self.pending = ""
+
+	def write(self, text):
+		""" Write part of the content; trailing whitespace is held back, as it might be the end """
+		text = self.pending + text
+		content = text.rstrip()
+		self.pending = text[len(content):]
+		if not self.started:
+			content = content.lstrip()
+			if not content:
+				self.pending = ""
+				return
+			self.out.write(f"{self.role}:\t")
+			self.started = True
+		self.out.write(re.sub(r'\n', '\n\t', content))
+
+	def flush(self):
+		""" Flush the output """
+		self.out.flush()
+
+	def close(self):
+		""" Finish the message """
+		if not self.started:
+			self.out.write(f"{self.role}:\t")
+		self.out.write("\n")
+		self.out.flush()
+
+
 def read_utf_replace(inp):
 	""" Read input, replacing invalid UTF-8 with the replacement character. """
 	try:
@@ -346,9 +855,16 @@ def read_utf_replace(inp):
 @argh.arg("-L", "--log", action="store_true", help=f"log to a file in {LOGDIR}")
 @argh.arg("-p", "--lines", action="store_true", help="process each line separately, like perl -p")
 @argh.arg("-R", "--repeat", action="store_true", help="repeat the prompt as prompt2, changing 'below' to 'above' only")
-def process(*prompt, prompt2: Optional[str]=None, inp: IO[str]=stdin, out: IO[str]=stdout, model: str=default_model, indent="\t", temperature=None, token_limit=None, retries=RETRIES, state_file=None, empty_ok=False, empty_to_empty=True, log=True, lines=False, repeat=False):
+@argh.arg("-j", "--jobs", type=int, help="with --lines, process this many lines at once")
+@argh.arg("--rpm", type=int, help="limit requests per minute to the model's provider")
+@argh.arg("--tpm", type=int, help="limit tokens per minute to the model's provider")
+@argh.arg("-S", "--stream", action="store_true", help="write the response as it arrives; not with --lines, and indentation is not fixed")
+@argh.arg("-C", "--cache", choices=CACHE_MODES, help="response cache: on, only (never call the model), or refresh; default $LLM_CACHE")
+def process(*prompt, prompt2: Optional[str]=None, inp: IO[str]=stdin, out: IO[str]=stdout, model: str=default_model, indent="\t", temperature=None, token_limit=None, retries=RETRIES, state_file=None, empty_ok=False, empty_to_empty=True, log=True, lines=False, repeat=False, jobs=JOBS, rpm=None, tpm=None, cache=None, stream=False):
 	""" Process some text through the LLM with a prompt. """
 	set_opts(vars())
+	if rpm or tpm:
+		set_rate_limit(model_provider(opts.model), rpm=rpm, tpm=tpm)
 
 	prompt = " ".join(prompt)
 	prompt = prompt.rstrip()
@@ -367,25 +883,43 @@ def process(*prompt, prompt2: Optional[str]=None, inp: IO[str]=stdin, out: IO[st
 		prompt2 = re.sub(r"\bbelow\b", "above", prompt)
 
 	if not lines:
-		return process2(prompt, prompt2, input_text, out=out, model=model, indent=indent, temperature=temperature, token_limit=token_limit, retries=retries, state_file=state_file, log=log)
+		return process2(prompt, prompt2, input_text, out=out, model=model, indent=indent, temperature=temperature, token_limit=token_limit, retries=retries, state_file=state_file, log=log, cache=cache, stream=stream)
 
 	# split the input into lines
-	lines = input_text.splitlines()
-	output = []
+	lines = [line.rstrip() for line in input_text.splitlines()]
+	lines = [line for line in lines if line]
+
+	def process_line(line):
+		return process2(prompt, prompt2, line, out=None, model=model, indent=indent, temperature=temperature, token_limit=token_limit, retries=retries, state_file=state_file, log=log, cache=cache, stream=stream)
 
-	for line in lines:
-		line = line.rstrip()
-		if not line:
-			continue
-		output1 = process2(prompt, prompt2, line, out=out, model=model, indent=indent, temperature=temperature, token_limit=token_limit, retries=retries, state_file=state_file, log=log)
-		output.append(output1)
+	output = []
+	failed = 0
+
+	# results come back in input order; a failed line is logged and skipped
+	with ThreadPoolExecutor(max_workers=max(1, jobs or JOBS)) as executor:
+		futures = [executor.submit(process_line, line) for line in lines]
+		for line, future in zip(lines, futures):
+			try:
+				output1 = future.result()
+			except Exception as ex:  # pylint: disable=broad-except
+				logger.error("process: line failed: %r: %s", line, ex)
+				failed += 1
+				continue
+			if out:
+				out.write(output1)
+				out.flush()
+			else:
+				output.append(output1)
+
+	if failed:
+		raise RuntimeError(f"process: {failed} of {len(lines)} lines failed")
 
 	output_s = "\n".join(output)
 
 	return output_s
 
 
-def process2(prompt, prompt2, input_text, out, model, indent, temperature, token_limit, retries, state_file, log):
+def process2(prompt, prompt2, input_text, out, model, indent, temperature, token_limit, retries, state_file, log, cache, stream):
 	""" Process some text through the LLM with a prompt. """
 	full_input = f"""
 {prompt}
@@ -394,10 +928,10 @@ def process2(prompt, prompt2, input_text, out, model, indent, temperature, token
 """
 	if prompt2:
 		full_input += "\n" + prompt2 + "\n"
-	return query(full_input, out=out, model=model, indent=indent, temperature=temperature, token_limit=token_limit, retries=retries, state_file=state_file, log=log)
+	return query(full_input, out=out, model=model, indent=indent, temperature=temperature, token_limit=token_limit, retries=retries, state_file=state_file, log=log, cache=cache, stream=stream)
 
 
-def query(*prompt, out: Optional[IO[str]]=stdout, model: str=default_model, indent="\t", temperature=None, token_limit=None, retries=RETRIES, state_file=None, log=True):  # pylint: disable=unused-argument
+def query(*prompt, out: Optional[IO[str]]=stdout, model: str=default_model, indent="\t", temperature=None, token_limit=None, retries=RETRIES, state_file=None, log=True, cache=None, stream=False):  # pylint: disable=unused-argument
 	""" Ask the LLM a question. """
 	set_opts(vars())
 	return retry(query2, retries, *prompt, out=out, log=log)
@@ -412,11 +946,12 @@ def query2(*prompt, out: Optional[IO[str]]=stdout, log=True):
 	# TODO use a system message?
 
 	input_message = {"role": "user", "content": prompt}
-	output_message = llm_chat([input_message])
+	stream = out if opts.stream else None
+	output_message = llm_chat([input_message], out=stream)
 	content = output_message["content"]
 
-	# fix indentation for code
-	if opts.indent:
+	# fix indentation for code; we can't when streaming
+	if opts.indent and not stream:
 		lines = content.splitlines()
 		lines = tab.fix_indentation_list(lines, opts.indent)
 		content = "".join(lines)
@@ -428,6 +963,8 @@ def query2(*prompt, out: Optional[IO[str]]=stdout, log=True):
 			logfile = Path(f"{base}.{time_s}")
 		logfile.write_text(content, encoding="utf-8")
 
+	if stream:
+		return ""
 	if out:
 		out.write(content)
 		return ""
@@ -435,22 +972,238 @@ def query2(*prompt, out: Optional[IO[str]]=stdout, log=True):
 	return content
 
 
-def retry(fn, n_tries, *args, sleep_min=1, sleep_max=2, **kwargs):
-	""" Retry a function n_tries times. """
-	for i in range(n_tries):
-		try:
-			return fn(*args, **kwargs)
-		except Exception as ex:  # pylint: disable=broad-except
-			delay = random.uniform(sleep_min, sleep_max)
-			logger.warning("retry: exception, sleeping for %.3f: %s", delay, ex)
-			msg = str(ex)
-			bad = any(bad_error in msg for bad_error in BAD_ERRORS_NO_RETRY)
-			if bad or i == n_tries - 1:
+def error_status(ex):
+	""" The HTTP status of an error from any provider, if known """
+	status = getattr(ex, "http_status", None)
+	if status is None and getattr(ex, "response", None) is not None:
+		status = getattr(ex.response, "status_code", None)
+	if status is None and isinstance(ex, anthropic.ApiException):
+		match = re.search(r"status code: (\d+)", str(ex))
+		status = int(match[1]) if match else None
+	return status
+
+
+def retry_after(ex):
+	""" The delay in seconds that the server asked for in a Retry-After header, if any """
+	headers = getattr(ex, "headers", None)
+	if not headers and getattr(ex, "response", None) is not None:
+		headers = getattr(ex.response, "headers", None)
+	if not headers:
+		return None
+	value = headers.get("Retry-After") or headers.get("retry-after")
+	if not value:
+		return None
+	try:
+		return max(0.0, float(value))
+	except ValueError:
+		pass
+	try:
+		return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+	except (TypeError, ValueError):
+		return None
+
+
+class RaceLost(Exception):
+	""" Another model answered first. """
+
+
+def classify_error(ex):
+	""" Classify an error as FATAL, RATE_LIMIT or TRANSIENT, to decide whether and how to retry """
+	msg = str(ex)
+	if any(bad_error in msg for bad_error in BAD_ERRORS_NO_RETRY):
+		return FATAL
+	if isinstance(ex, openai.error.RateLimitError):
+		# running out of quota also comes as a rate limit error, but waiting won't help
+		return FATAL if ex.code == "insufficient_quota" else RATE_LIMIT
+	if isinstance(ex, (openai.error.InvalidRequestError, openai.error.AuthenticationError, openai.error.PermissionError)):
+		return FATAL
+	if isinstance(ex, (openai.error.APIConnectionError, openai.error.Timeout, openai.error.ServiceUnavailableError, openai.error.TryAgain, requests.ConnectionError, requests.Timeout)):
+		return TRANSIENT
+	status = error_status(ex)
+	if status == 429:
+		return RATE_LIMIT
+	if status in (408, 409) or status is not None and status >= 500:
+		return TRANSIENT
+	if status is not None and 400 <= status < 500:
+		return FATAL
+	# likely a bug, or bad input; but a garbled response is worth another try
+	if isinstance(ex, (TypeError, AttributeError, NameError, LookupError, ValueError)) and not isinstance(ex, json.JSONDecodeError):
+		return FATAL
+	return TRANSIENT
+
+
+class RetryPolicy(AutoInit):  # pylint: disable=too-few-public-methods
+	""" How to retry: jittered exponential backoff, honouring server hints, within a total deadline. """
+	n_tries: int = RETRIES
+	sleep_min: float = 1
+	sleep_max: float = 2
+	max_sleep: float = RETRY_MAX_SLEEP
+	deadline: Optional[float] = RETRY_DEADLINE
+
+	def delay(self, ex, kind, attempt):
+		""" How long to sleep before the next try """
+		delay = min(self.max_sleep, random.uniform(self.sleep_min, self.sleep_max) * 2 ** attempt)
+		hint = retry_after(ex) if kind == RATE_LIMIT else None
+		if hint is not None:
+			# a little jitter, so waiting callers don't all come back at once
+			delay = hint + random.uniform(0, self.sleep_min)
+		return delay
+
+	def run(self, fn, *args, **kwargs):
+		""" Call fn, retrying as the policy says """
+		start = time.monotonic()
+		for attempt in range(self.n_tries):
+			try:
+				return fn(*args, **kwargs)
+			except RaceLost:
+				# cancelled, not an error
 				raise
-			time.sleep(delay)
-			sleep_min *= 2
-			sleep_max *= 2
-	return None
+			except Exception as ex:  # pylint: disable=broad-except
+				kind = classify_error(ex)
+				if kind == FATAL:
+					logger.warning("retry: %s error, not retrying: %s", kind, ex)
+					raise
+				if attempt == self.n_tries - 1:
+					raise
+				delay = self.delay(ex, kind, attempt)
+				if self.deadline is not None and time.monotonic() - start + delay > self.deadline:
+					logger.warning("retry: %s error, deadline reached: %s", kind, ex)
+					raise
+				logger.warning("retry: %s error, sleeping for %.3f: %s", kind, delay, ex)
+				if kind == RATE_LIMIT:
+					# make other callers to this provider back off too
+					try:
+						get_rate_limiter(model_provider(opts.model)).pause(delay)
+					except ValueError:
+						pass
+				time.sleep(delay)
+		return None
+
+
+def retry(fn, n_tries, *args, sleep_min=1, sleep_max=2, deadline=RETRY_DEADLINE, **kwargs):
+	""" Retry a function up to n_tries times, following a RetryPolicy. """
+	policy = RetryPolicy(n_tries=n_tries, sleep_min=sleep_min, sleep_max=sleep_max, deadline=deadline)
+	return policy.run(fn, *args, **kwargs)
+
+
+class RaceWriter:
+	""" Watches a racer's streamed response, and stops the stream once the racer has lost. """
+	def __init__(self):
+		self.started = False
+		self.lost = False
+
+	def write(self, _text):
+		""" Note that the racer has started answering, or stop if it lost """
+		if self.lost:
+			raise RaceLost("cancelled")
+		self.started = True
+
+	def flush(self):
+		""" Nothing to flush """
+
+
+class RaceStats:
+	""" Win and latency stats for a model in races """
+	def __init__(self):
+		self.starts = 0
+		self.wins = 0
+		self.errors = 0
+		self.cancelled = 0
+		self.latencies = deque(maxlen=RACE_LATENCIES)
+
+	def median_latency(self):
+		""" The median latency of recent wins """
+		latencies = sorted(self.latencies)
+		return latencies[len(latencies) // 2] if latencies else None
+
+
+race_stats: dict[str, RaceStats] = {}
+race_stats_lock = threading.Lock()
+race_executor = ThreadPoolExecutor(max_workers=RACE_WORKERS, thread_name_prefix="race")
+
+
+def race_stat(model, field):
+	""" Count an event for a model in the race stats """
+	with race_stats_lock:
+		stats = race_stats.setdefault(model, RaceStats())
+		setattr(stats, field, getattr(stats, field) + 1)
+
+
+def race_attempt(messages, writer):
+	""" One try for a racer, unless it has already lost """
+	if writer.lost:
+		raise RaceLost("cancelled")
+	return llm_chat(messages, out=writer)
+
+
+def race_one(_opts, messages, retries, writer):
+	""" Run one model in a race, streaming so that it can be stopped if it loses """
+	start = time.monotonic()
+	response = with_thread_opts(_opts, retry, race_attempt, retries, messages, writer)
+	return response, time.monotonic() - start
+
+
+def race(messages, models, hedge=HEDGE_DELAY, retries=RETRIES):
+	""" Send messages to the first model, then to each fallback model in turn if none has started answering within hedge
+	seconds, or as soon as one fails. Return the first full response, and stop the rest. With hedge=0, all models race at once.
+
+	A losing racer is stopped at its next streamed token, or before its next try. Bard can't stream, so a losing Bard
+	request runs to completion in the background, and its response is dropped. """
+	base_opts = get_opts_dict()
+	waiting = deque(get_model_by_abbrev(model) for model in models)
+	running = {}
+	last_error = None
+	start_next = True
+	try:
+		while True:
+			if start_next and waiting:
+				model = waiting.popleft()
+				writer = RaceWriter()
+				future = race_executor.submit(race_one, {**base_opts, "model": model}, messages, retries, writer)
+				running[future] = model, writer
+				race_stat(model, "starts")
+				start_next = hedge == 0
+				continue
+			if not running:
+				break
+			finished, _ = wait(running, timeout=hedge if waiting and hedge else None, return_when=FIRST_COMPLETED)
+			if not finished:
+				# don't hedge against a model that is already answering
+				if not any(writer.started for _model, writer in running.values()):
+					logger.info("race: no answer in %s seconds, hedging", hedge)
+					start_next = True
+				continue
+			for future in finished:
+				model, _writer = running.pop(future)
+				try:
+					response, latency = future.result()
+				except Exception as ex:  # pylint: disable=broad-except
+					logger.warning("race: %s failed: %s", model, ex)
+					race_stat(model, "errors")
+					last_error = ex
+					start_next = True
+					continue
+				with race_stats_lock:
+					stats = race_stats.setdefault(model, RaceStats())
+					stats.wins += 1
+					stats.latencies.append(latency)
+				logger.info("race: %s won in %.3f seconds", model, latency)
+				return response
+	finally:
+		for future, (model, writer) in running.items():
+			writer.lost = True
+			future.cancel()
+			race_stat(model, "cancelled")
+	raise last_error or ValueError("race: no models")
+
+
+def race_report(out=stdout):
+	""" Write the race stats by provider and model, as TSV """
+	print("provider", "model", "starts", "wins", "errors", "cancelled", "median_latency", sep="\t", file=out)
+	with race_stats_lock:
+		for model, stats in sorted(race_stats.items(), key=lambda item: (model_provider(item[0]), item[0])):
+			latency = stats.median_latency()
+			print(model_provider(model), model, stats.starts, stats.wins, stats.errors, stats.cancelled, "" if latency is None else f"{latency:.3f}", sep="\t", file=out)
 
 
 #def dict_to_namespace(d):
@@ -461,33 +1214,239 @@ def retry(fn, n_tries, *args, sleep_min=1, sleep_max=2, **kwargs):
 #	return ns
 
 
-def chat(inp=stdin, out=stdout, model=default_model, fake=False, temperature=None, token_limit=None, retries=RETRIES, state_file=None, auto_save=None):  # pylint: disable=unused-argument
+def chat(inp=stdin, out=stdout, model=default_model, fake=False, temperature=None, token_limit=None, retries=RETRIES, state_file=None, auto_save=None, cache=None, stream=False):  # pylint: disable=unused-argument
 	""" Chat with the LLM, well it inputs a chat file and ouputs the new message to append. """
 	set_opts(vars())
 	return retry(chat2, retries, inp=inp, out=out)
 
 
+@argh.arg("-i", "--inp", default=stdin, help="JSONL input: objects with prompt or messages, and optionally id")
+@argh.arg("-o", "--out", default=stdout, help="JSONL output: objects with id and response or error")
+@argh.arg("-m", "--model", default=default_model, help="model name")
+@argh.arg("-t", "--temperature", type=float, help="temperature")
+@argh.arg("-l", "--token-limit", type=int, help="token limit")
+@argh.arg("-r", "--retries", type=int, default=RETRIES, help="number of retries")
+@argh.arg("-j", "--jobs", type=int, help="number of requests in flight")
+@argh.arg("-k", "--checkpoint", help="file of finished results; resume from it, and don't send those again")
+@argh.arg("--rpm", type=int, help="limit requests per minute to the model's provider")
+@argh.arg("--tpm", type=int, help="limit tokens per minute to the model's provider")
+@argh.arg("-C", "--cache", choices=CACHE_MODES, help="response cache: on, only, or refresh; default $LLM_CACHE")
+def batch(inp: IO[str]=stdin, out: IO[str]=stdout, model: str=default_model, temperature=None, token_limit=None, retries=RETRIES, jobs=BATCH_JOBS, checkpoint=None, rpm=None, tpm=None, cache=None):  # pylint: disable=unused-argument
+	""" Send a JSONL batch of prompts or conversations to the LLM, and write the results as JSONL as they finish. """
+	set_opts(vars())
+	if rpm or tpm:
+		set_rate_limit(model_provider(opts.model), rpm=rpm, tpm=tpm)
+
+	done = load_checkpoint(checkpoint) if checkpoint else {}
+	for result in done.values():
+		out.write(json.dumps(result) + "\n")
+	out.flush()
+	if done:
+		logger.info("batch: resuming, %d items already done", len(done))
+
+	items = ((item.get("id", i), item) for i, item in enumerate(read_jsonl(inp)))
+	items = ((item_id, item) for item_id, item in items if item_id not in done)
+
+	failed = 0
+	checkpoint_file = open(checkpoint, "a", encoding="utf-8") if checkpoint else None  # pylint: disable=consider-using-with
+	if checkpoint_file and checkpoint_file.tell() and not checkpoint_ends_with_newline(checkpoint):
+		checkpoint_file.write("\n")
+	try:
+		with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+			running = {}
+			while True:
+				# keep a bounded number of items in flight, reading more as they finish
+				for item_id, item in items:
+					running[executor.submit(batch_item, item, retries)] = item_id
+					if len(running) >= jobs:
+						break
+				if not running:
+					break
+				finished, _ = wait(running, return_when=FIRST_COMPLETED)
+				for future in finished:
+					item_id = running.pop(future)
+					try:
+						result = {"id": item_id, "response": future.result()}
+					except Exception as ex:  # pylint: disable=broad-except
+						logger.error("batch: item %r failed: %s", item_id, ex)
+						result = {"id": item_id, "error": str(ex)}
+						failed += 1
+					line = json.dumps(result) + "\n"
+					if checkpoint_file and "response" in result:
+						checkpoint_file.write(line)
+						checkpoint_file.flush()
+					out.write(line)
+					out.flush()
+	finally:
+		if checkpoint_file:
+			checkpoint_file.close()
+
+	if failed:
+		raise RuntimeError(f"batch: {failed} items failed; run again with the checkpoint to retry them")
+
+
+def batch_item(item, retries):
+	""" Send one batch item to the LLM, and return the response content. """
+	if "messages" in item:
+		messages = item["messages"]
+	else:
+		messages = [{"role": "user", "content": item["prompt"]}]
+	response = retry(llm_chat, retries, messages)
+	return response["content"]
+
+
+def read_jsonl(inp):
+	""" Read objects from JSONL, skipping blank lines. """
+	for line in inp:
+		if line.strip():
+			yield json.loads(line)
+
+
+def load_checkpoint(checkpoint):
+	""" Load finished results from a checkpoint file, by id; a partly written last line is ignored. """
+	done = {}
+	try:
+		with open(checkpoint, encoding="utf-8") as f:
+			for line in f:
+				try:
+					result = json.loads(line)
+				except json.JSONDecodeError:
+					logger.warning("batch: ignoring bad line in checkpoint: %r", line)
+					continue
+				done[result["id"]] = result
+	except FileNotFoundError:
+		pass
+	return done
+
+
+def checkpoint_ends_with_newline(checkpoint):
+	""" Check that a checkpoint file ends with a complete line. """
+	with open(checkpoint, "rb") as f:
+		f.seek(-1, os.SEEK_END)
+		return f.read(1) == b"\n"
+
+
 def chat2(inp=stdin, out=stdout):
 	""" Chat with the LLM, well it inputs a chat file and ouputs the new message to append. """
 	input_lines = read_utf_replace(inp).splitlines()
 	input_messages = lines_to_messages(input_lines)
+	if opts.stream:
+		writer = MessageStreamWriter(out)
+		llm_chat(input_messages, out=writer)
+		writer.close()
+		return
 	response_message = llm_chat(input_messages)
 	output_lines = messages_to_lines([response_message])
 	out.writelines(output_lines)
 
 
-def count(inp=stdin, model=default_model):
+@argh.arg("-b", "--batch", help="read JSONL of strings or objects with text or messages, and write JSONL with tokens added")
+def count(inp=stdin, out=stdout, model=default_model, batch=False):
 	""" count tokens in a file """
 	set_opts(vars())
+	if batch:
+		return count_jsonl(inp, out, opts.model)
 	text = read_utf_replace(inp)
-	model = opts.model
+	return count_tokens(text, opts.model)
+
+
+def count_jsonl(inp, out, model):
+	""" count tokens for each item in a JSONL stream, in batches """
+	while True:
+		lines = [line for line in (inp.readline() for _ in range(COUNT_BATCH_SIZE)) if line]
+		if not lines:
+			break
+		items = [json.loads(line) for line in lines if line.strip()]
+		items = [item if isinstance(item, dict) else {"text": item} for item in items]
+		# the model can be given per item
+		by_model = {}
+		for i, item in enumerate(items):
+			by_model.setdefault(get_model_by_abbrev(item.get("model", model)), []).append(i)
+		for item_model, indices in by_model.items():
+			texts = [item_text(items[i]) for i in indices]
+			for i, tokens in zip(indices, count_tokens_batch(texts, item_model)):
+				items[i]["tokens"] = tokens
+		for item in items:
+			out.write(json.dumps(item) + "\n")
+		out.flush()
+
+
+def item_text(item):
+	""" the text of a batch item, from text or messages """
+	if "messages" in item:
+		return "".join(message["content"] for message in item["messages"])
+	return item["text"]
+
+
+encoders: dict[str, tuple] = {}
+token_counts: OrderedDict[tuple, int] = OrderedDict()
+token_counts_lock = threading.Lock()
+
+
+def get_encoder(model):
+	""" get a cached encoder for a model: its name, and a function to count tokens in a list of texts """
+	encoder = encoders.get(model)
+	if encoder:
+		return encoder
 	if model.startswith("gpt"):
-		enc = tiktoken.get_encoding("cl100k_base")
-		tokens = enc.encode(text)
-		return len(tokens)
-	if model.startswith("claude"):
-		return claude.count(text)
-	raise ValueError(f"unknown model: {model}")
+		try:
+			enc = tiktoken.encoding_for_model(model)
+		except KeyError:
+			enc = tiktoken.get_encoding("cl100k_base")
+		encoder = enc.name, lambda texts: [len(tokens) for tokens in enc.encode_ordinary_batch(texts)]
+	elif model.startswith("claude"):
+		encoder = "claude", claude.count_batch
+	elif model.startswith("mock"):
+		encoder = "mock", lambda texts: [len(text.split()) for text in texts]
+	else:
+		raise ValueError(f"unknown model: {model}")
+	encoders[model] = encoder
+	return encoder
+
+
+def count_tokens_batch(texts, model):
+	""" count tokens in many texts, remembering counts by content hash """
+	name, count_batch = get_encoder(model)
+	keys = [(name, hashlib.blake2b(text.encode("utf-8", errors="surrogatepass"), digest_size=16).digest()) for text in texts]
+	found = {}
+	missing = {}
+	with token_counts_lock:
+		for i, key in enumerate(keys):
+			tokens = token_counts.get(key)
+			if tokens is None:
+				missing.setdefault(key, i)
+			else:
+				found[key] = tokens
+				token_counts.move_to_end(key)
+	if missing:
+		new_counts = count_batch([texts[i] for i in missing.values()])
+		found.update(zip(missing, new_counts))
+		with token_counts_lock:
+			token_counts.update(zip(missing, new_counts))
+			while len(token_counts) > TOKEN_COUNT_CACHE_SIZE:
+				token_counts.popitem(last=False)
+	return [found[key] for key in keys]
+
+
+def count_tokens(text, model):
+	""" count tokens in some text """
+	return count_tokens_batch([text], model)[0]
+
+
+@argh.arg("action", choices=["stats", "evict", "clear"], help="show stats, evict old responses, or clear the cache")
+@argh.arg("-n", "--max-entries", type=int, help="with evict, keep at most this many responses")
+@argh.arg("-a", "--max-age", type=float, help="with evict, remove responses not used for this many days")
+def cache(action, max_entries=CACHE_MAX_ENTRIES, max_age=None):
+	""" Manage the response cache. """
+	response_cache = get_response_cache()
+	if action == "stats":
+		for model, count, size in response_cache.stats():
+			print(model, count, size, sep="\t")
+	elif action == "evict":
+		count = response_cache.evict(max_entries=max_entries, max_age=max_age * 86400 if max_age is not None else None)
+		print(count)
+	elif action == "clear":
+		response_cache.clear()
 
 
 def list_models():
@@ -497,4 +1456,4 @@ def list_models():
 
 
 if __name__ == "__main__":
-	argh.dispatch_commands([chat, query, process, count, list_models])
+	argh.dispatch_commands([chat, query, process, batch, count, cache, list_models])
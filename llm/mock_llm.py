@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+""" mock_llm.py: a local stand-in LLM for load testing, with realistic latency, streaming and errors """
+
+import os
+import sys
+import time
+import random
+import logging
+import threading
+
+import argh
+
+
+logger = logging.getLogger(__name__)
+
+WORDS = """the a of to and in is it you that he was for on are with as I his they be at one have this from or had by
+not word but what some we can out other were all there when up use your how said an each she which do their time if
+will way about many then them write would like so these her long make thing see him two has look more day could go
+come did number sound no most people my over know water than call first who may down side been now find""".split()
+
+
+class MockError(Exception):
+	""" An API error from the mock LLM, with an HTTP status and headers like the real clients' errors """
+	def __init__(self, message, http_status=500, headers=None):
+		super().__init__(message)
+		self.http_status = http_status
+		self.headers = headers or {}
+
+
+class MockLLM:  # pylint: disable=too-many-instance-attributes
+	""" A mock LLM: lognormal latency, streaming at a token rate, and random rate limit and server errors """
+	latency: float = 0.5        # median seconds to the first token
+	latency_sigma: float = 0.5  # lognormal sigma of the latency
+	rate: float = 50.0          # tokens per second, after the first
+	tokens: int = 100           # mean tokens in a response
+	context: int = 8192         # context length in tokens, prompt plus response
+	rate_limit: float = 0.0     # chance of a rate limit error
+	retry_after: float = 1.0    # seconds to ask the client to wait after a rate limit error
+	error: float = 0.0          # chance of a server error
+	seed: int = None
+
+	def __init__(self, **kwargs):
+		for k, v in kwargs.items():
+			if not hasattr(self, k):
+				raise ValueError(f"unknown mock LLM setting: {k}")
+			default = getattr(self, k)
+			setattr(self, k, int(v) if default is None else type(default)(v))
+		self.rng = random.Random(self.seed)
+		self.lock = threading.Lock()
+
+	@classmethod
+	def from_spec(cls, spec):
+		""" Create a mock LLM from a spec like "latency=0.2,rate=100,rate_limit=0.05" """
+		settings = dict(item.split("=", 1) for item in spec.split(",") if item.strip()) if spec else {}
+		return cls(**settings)
+
+	def sample(self):
+		""" Sample a request's fate: first token latency, response length, and whether it fails """
+		with self.lock:
+			latency = self.latency * self.rng.lognormvariate(0, self.latency_sigma)
+			n_tokens = max(1, round(self.rng.expovariate(1 / self.tokens))) if self.tokens else 0
+			roll = self.rng.random()
+			words = [self.rng.choice(WORDS) for _ in range(n_tokens)]
+		if roll < self.rate_limit:
+			failure = "rate_limit"
+		elif roll < self.rate_limit + self.error:
+			failure = "error"
+		else:
+			failure = None
+		return latency, words, failure
+
+	def complete(self, prompt, out=None, max_tokens=None):
+		""" Complete a prompt, sleeping as a real LLM would take, and streaming to out if given """
+		prompt_tokens = len(prompt.split())
+		if prompt_tokens >= self.context:
+			raise MockError(f"[context_length_exceeded] Prompt is too long: {prompt_tokens} tokens >= {self.context}", http_status=400)
+		latency, words, failure = self.sample()
+		words = words[:min(max_tokens or len(words), self.context - prompt_tokens)]
+		if failure == "rate_limit":
+			time.sleep(min(latency, 0.1))
+			raise MockError("rate limit exceeded", http_status=429, headers={"Retry-After": str(self.retry_after)})
+		time.sleep(latency)
+		if failure == "error":
+			raise MockError("internal server error", http_status=500)
+		if out is None:
+			time.sleep(max(0, len(words) - 1) / self.rate)
+			return " ".join(words)
+		for i, word in enumerate(words):
+			if i:
+				time.sleep(1 / self.rate)
+				word = " " + word
+			out.write(word)
+			out.flush()
+		return " ".join(words)
+
+	def chat(self, messages, out=None):
+		""" Chat with the mock LLM, and return the response message """
+		prompt = "\n".join(message["content"] for message in messages)
+		return {"role": "assistant", "content": self.complete(prompt, out=out)}
+
+
+mock = None
+mock_lock = threading.Lock()
+
+
+def get_mock():
+	""" Get the process's mock LLM, configured by $LLM_MOCK """
+	global mock  # pylint: disable=global-statement
+	with mock_lock:
+		if mock is None:
+			mock = MockLLM.from_spec(os.environ.get("LLM_MOCK", ""))
+		return mock
+
+
+def query(*prompt, spec=None):
+	""" Ask the mock LLM a question, streaming the response """
+	llm = MockLLM.from_spec(spec) if spec else get_mock()
+	llm.complete(" ".join(prompt), out=sys.stdout)
+	print()
+
+
+if __name__ == "__main__":
+	argh.dispatch_command(query)
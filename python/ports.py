@@ -30,7 +30,8 @@ def prepare_request(port, config=None):
 	""" Make a request to the core server. """
 	global req_id
 	prep = port/"prep"
-	req = prep/f"req-{req_id:06d}"
+	# the pid keeps it unique between clients using the same port
+	req = prep/f"req-{os.getpid()}-{req_id:06d}"
 	req_id += 1
 
 	# create the request directory, needs to be group writable
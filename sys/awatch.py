@@ -7,15 +7,25 @@ import os
 import argparse
 import logging
 from pathlib import Path
+from stat import S_ISDIR
 import re
+import time
+import gzip
+import asyncio
+from collections import namedtuple
 
 from watchfiles import awatch, Change, DefaultFilter
 
 import ucm
+import atail
 
 
 logger = logging.getLogger(__name__)
 
+STATE_HEADER = "# awatch state 1"
+
+FileChange = namedtuple("FileChange", "path change old_size new_size")
+
 
 class WatcherOptions: # pylint: disable=too-few-public-methods
 	""" WatcherOptions: a class that holds the options for the Watcher class """
@@ -25,6 +35,17 @@ class WatcherOptions: # pylint: disable=too-few-public-methods
 	dirs = False
 	inital_state = False
 	follow = False
+	state_file = None
+	state_interval = 60
+	coalesce = 0
+
+
+def watcher_options(**kwargs):
+	""" Make WatcherOptions, overriding some of the defaults """
+	opts = WatcherOptions()
+	for k, v in kwargs.items():
+		setattr(opts, k, v)
+	return opts
 
 
 class Watcher:
@@ -37,16 +58,38 @@ class Watcher:
 		self.opts = opts
 		self.default_filter = DefaultFilter()
 		self.file_sizes = {}
+		self.file_mtimes = {}
 		self.dirs = set()
+		self.state_saved_at = 0
 
 	async def run(self):
 		""" Watch the files and directories """
 
-		for path in self.paths:
-			async for row in self.handle_change(Change.added, path):
-				if self.opts.inital_state:
+		state = self.load_state()
+
+		try:
+			if state:
+				for row in self.changes_since(*state):
 					yield row
+				yield self.flush
+			else:
+				for path in self.paths:
+					async for row in self.handle_change(Change.added, path):
+						if self.opts.inital_state:
+							yield row
+			self.save_state()
+
+			if self.opts.coalesce:
+				rows = self.coalesce(self.watch())
+			else:
+				rows = self.watch()
+			async for row in rows:
+				yield row
+		finally:
+			self.save_state()
 
+	async def watch(self):
+		""" Watch for changes, yielding a row for each, and a flush after each batch """
 		watcher = awatch(*self.paths, watch_filter=self.watch_filter)
 
 		async for changes in watcher:
@@ -54,15 +97,151 @@ class Watcher:
 				async for row in self.handle_change(change_type, path):
 					yield row
 			yield self.flush
+			if time.time() - self.state_saved_at >= self.opts.state_interval:
+				self.save_state()
+
+	async def coalesce(self, rows):
+		""" Merge changes to each path within the coalesce window, and emit them when it ends """
+		coalescer = Coalescer(self.opts.coalesce)
+		loop = asyncio.get_running_loop()
+		queue = asyncio.Queue()
+		reader = asyncio.create_task(self.read_rows(rows, queue))
+		try:
+			while True:
+				if queue.empty():
+					deadline = coalescer.next_deadline()
+					timeout = None if deadline is None else max(0, deadline - loop.time())
+					try:
+						row = await asyncio.wait_for(queue.get(), timeout)
+					except asyncio.TimeoutError:
+						row = self.flush  # nothing new, but some changes are due
+				else:
+					row = queue.get_nowait()
+				if row is None:
+					break
+				if row is not self.flush:
+					coalescer.add(row, loop.time())
+				due = list(coalescer.due(loop.time()))
+				for row in due:
+					yield row
+				if due:
+					yield self.flush
+			await reader  # raise its error, if any
+		finally:
+			reader.cancel()
+		for row in coalescer.due(None):
+			yield row
+		yield self.flush
+
+	@staticmethod
+	async def read_rows(rows, queue):
+		""" Read the rows into a queue, then None at the end """
+		try:
+			async for row in rows:
+				queue.put_nowait(row)
+		finally:
+			queue.put_nowait(None)
+
+	def load_state(self):
+		""" Load the sizes, mtimes and dirs saved by a previous run, if any """
+		state_file = self.opts.state_file
+		if not state_file or not Path(state_file).exists():
+			return None
+		file_sizes = {}
+		file_mtimes = {}
+		dirs = set()
+		try:
+			with gzip.open(state_file, "rt", encoding="utf-8") as f:
+				header = f.readline().rstrip("\n").split("\t")
+				if header != [STATE_HEADER, *self.paths]:
+					logger.warning("state file %r is for different paths, ignoring it", state_file)
+					return None
+				for line in f:
+					kind, path, *rest = line.rstrip("\n").split("\t")
+					if kind == "d":
+						dirs.add(path)
+					else:
+						file_sizes[path] = int(rest[0])
+						file_mtimes[path] = int(rest[1])
+		except (OSError, ValueError, IndexError, EOFError) as e:
+			logger.warning("could not load state file %r: %r", state_file, e)
+			return None
+		return file_sizes, file_mtimes, dirs
+
+	def save_state(self):
+		""" Save the sizes, mtimes and dirs atomically, so a restart can pick up where we left off """
+		state_file = self.opts.state_file
+		if not state_file:
+			return
+		temp = f"{state_file}.{os.getpid()}.tmp"
+		with gzip.open(temp, "wt", encoding="utf-8", compresslevel=1) as f:
+			print(STATE_HEADER, *self.paths, sep="\t", file=f)
+			for path in self.dirs:
+				print("d", path, sep="\t", file=f)
+			for path, size in self.file_sizes.items():
+				print("f", path, size, self.file_mtimes.get(path, 0), sep="\t", file=f)
+		os.replace(temp, state_file)
+		self.state_saved_at = time.time()
+
+	def changes_since(self, file_sizes, file_mtimes, dirs):
+		""" Scan the paths, and yield rows for what changed since the saved state, filtered as when watching """
+		self.file_sizes = {}
+		self.file_mtimes = {}
+		self.dirs = set()
+		for path in self.paths:
+			self.scan(path, top=True)
+		file_sizes = {path: size for path, size in file_sizes.items() if self.wanted(Change.deleted, path, False)}
+		dirs = {path for path in dirs if self.wanted(Change.deleted, path, True)}
+
+		for path in self.dirs - dirs:
+			if self.opts.dirs:
+				yield [path + os.path.sep, int(Change.added), None, None]
+		for path, size_new in self.file_sizes.items():
+			size = file_sizes.pop(path, None)
+			mtime = file_mtimes.pop(path, None)
+			if size is None:
+				yield [path, int(Change.added), None, size_new]
+			elif size != size_new or mtime != self.file_mtimes[path]:
+				yield [path, int(Change.modified), size, size_new]
+		for path, size in file_sizes.items():
+			yield [path, int(Change.deleted), size, None]
+		for path in dirs - self.dirs:
+			if self.opts.dirs:
+				yield [path + os.path.sep, int(Change.deleted), None, None]
+
+	def scan(self, path, top=False):
+		""" Record the sizes and mtimes of the files we watch under a path, without emitting rows """
+		if re.search(r'[\n\t]', path):
+			logger.warning("path contains newline or tab: %r", path)
+			return
+		try:
+			st = os.stat(path)
+		except OSError:
+			return
+		is_dir = S_ISDIR(st.st_mode)
+		if not top and not self.wanted(Change.added, path, is_dir):
+			return
+		if is_dir:
+			if not self.opts.follow and os.path.islink(path):
+				return
+			self.dirs.add(path)
+			with os.scandir(path) as entries:
+				for e in entries:
+					self.scan(e.path)
+		else:
+			self.file_sizes[path] = st.st_size
+			self.file_mtimes[path] = st.st_mtime_ns
 
 	def watch_filter(self, change, path):
 		""" Filter out files and directories that we don't want to watch """
+		return self.wanted(change, path, Path(path).is_dir())
+
+	def wanted(self, change, path, is_dir):
+		""" Check if we want to watch a file or directory """
 		if not self.default_filter(change, path):
 			return False
 		if not self.opts.hidden and os.path.sep + "." in path:
 			return False
-		p = Path(path)
-		is_dir = p.is_dir()
 		if is_dir or path in self.dirs:
 			return True
 		return self.opts.all_files or path.endswith(self.opts.exts)
@@ -83,9 +262,12 @@ class Watcher:
 			is_dir = p.is_dir() and (self.opts.follow or not p.is_symlink())
 
 		size = self.file_sizes.pop(path, None)
+		self.file_mtimes.pop(path, None)
 		size_new = None
 		if p.exists() and not p.is_dir():
-			size_new = p.stat().st_size
+			st = p.stat()
+			size_new = st.st_size
+			mtime_new = st.st_mtime_ns
 
 		if is_dir and change_type == Change.added:
 			async for row in self.added_directory(path):
@@ -97,6 +279,7 @@ class Watcher:
 			row = [path, int(change_type), size, size_new]
 			if size_new is not None:
 				self.file_sizes[path] = size_new
+				self.file_mtimes[path] = mtime_new
 			yield row
 
 	async def added_directory(self, path):
@@ -129,6 +312,52 @@ class Watcher:
 			yield row
 
 
+class Coalescer:
+	""" Coalescer: merges the changes to each path within a window """
+
+	def __init__(self, window):
+		""" Initialize the Coalescer object """
+		self.window = window
+		self.pending = {}
+
+	def add(self, row, now):
+		""" Add a change row, merging it with a pending change to the same path """
+		path, change, size, size_new = row
+		old = self.pending.get(path)
+		if old is None:
+			self.pending[path] = [row, now + self.window]
+			return
+		old_row = old[0]
+		old[0] = [path, merge_change(old_row[1], change), old_row[2], size_new]
+
+	def next_deadline(self):
+		""" The deadline of the oldest pending change, or None """
+		for _row, deadline in self.pending.values():
+			return deadline
+		return None
+
+	def due(self, now):
+		""" Remove and yield the merged changes whose windows have ended, or all if now is None """
+		while self.pending:
+			path, (row, deadline) = next(iter(self.pending.items()))
+			if now is not None and deadline > now:
+				break
+			del self.pending[path]
+			if row[1]:
+				yield row
+
+
+def merge_change(first, last):
+	""" The overall change for two consecutive changes to a path; 0 means no change """
+	if not first:
+		return last
+	if first == Change.added:
+		return 0 if last == Change.deleted else int(Change.added)
+	if last == Change.deleted:
+		return int(Change.deleted)
+	return int(Change.modified)
+
+
 def null_to(x, replacement):
 	""" Replace None with replacement """
 	if x is None:
@@ -136,15 +365,107 @@ def null_to(x, replacement):
 	return x
 
 
+def change_to_tsv(change):
+	""" Format a FileChange as a line for the changes log """
+	path, change_type, old_size, new_size = change
+	return "\t".join(str(null_to(x, '')) for x in (path, int(change_type), old_size, new_size)) + "\n"
+
+
+def tsv_to_change(line):
+	""" Parse a line from the changes log as a FileChange """
+	path, change_type, old_size, new_size = line.rstrip("\n").split("\t")
+	old_size = int(old_size) if old_size != "" else None
+	new_size = int(new_size) if new_size != "" else None
+	return FileChange(path, Change(int(change_type)), old_size, new_size)
+
+
+async def changes_from_log(watch_log):
+	""" Follow a changes log written by awatch, yielding FileChanges """
+	async for line in atail.multi.tail(watch_log, rewind=True):
+		yield tsv_to_change(line)
+
+
+class ChangeBus:
+	""" ChangeBus: publishes changes from a Watcher to subscribers in the same process """
+
+	def __init__(self):
+		""" Initialize the ChangeBus object """
+		self.queues = set()
+		self.tasks = []
+
+	def add_queue(self):
+		""" Add a queue to receive the changes """
+		queue = asyncio.Queue()
+		self.queues.add(queue)
+		return queue
+
+	def subscribe(self):
+		""" Subscribe to the changes, as an async iterator of FileChanges """
+		return self.subscription(self.add_queue())
+
+	async def subscription(self, queue):
+		""" Yield changes from a subscriber's queue until the bus closes """
+		try:
+			while (change := await queue.get()) is not None:
+				yield change
+		finally:
+			self.queues.discard(queue)
+
+	def publish(self, change):
+		""" Send a change to all subscribers """
+		for queue in self.queues:
+			queue.put_nowait(change)
+
+	def close(self):
+		""" Tell subscribers there will be no more changes """
+		self.publish(None)
+
+	async def run(self, watcher):
+		""" Publish the changes from a Watcher """
+		try:
+			async for row in watcher.run():
+				if row is not Watcher.flush:
+					self.publish(FileChange(row[0], Change(row[1]), row[2], row[3]))
+		finally:
+			self.close()
+
+	def log(self, out):
+		""" Log the changes as TSV, returning a coroutine to run """
+		return self.write_log(self.add_queue(), out)
+
+	async def write_log(self, queue, out):
+		""" Write changes from a queue to a TSV log, flushing whenever we catch up """
+		try:
+			while (change := await queue.get()) is not None:
+				out.write(change_to_tsv(change))
+				if queue.empty():
+					out.flush()
+		finally:
+			self.queues.discard(queue)
+			out.flush()
+
+	def start(self, paths, opts: WatcherOptions, log=None):
+		""" Start watching paths in the background, and optionally logging the changes """
+		if log:
+			self.tasks.append(asyncio.create_task(self.log(log)))
+		self.tasks.append(asyncio.create_task(self.run(Watcher(paths, opts))))
+
+
+def subscribe_changes(watch_log=None, paths=None, opts: WatcherOptions = None, log=None):
+	""" Get changes from a watcher in this process if paths are given, otherwise from a changes log """
+	if not paths:
+		return changes_from_log(watch_log)
+	bus = ChangeBus()
+	changes = bus.subscribe()
+	bus.start(paths, opts or WatcherOptions(), log)
+	return changes
+
+
 async def awatch_main(paths, opts: WatcherOptions, out=sys.stdout):
 	""" Main function for awatch """
-	w = Watcher(paths, opts)
-	async for row in w.run():
-		if row == Watcher.flush:
-			out.flush()
-			logger.info("flushed")
-		else:
-			print(*[null_to(x, '') for x in row], sep='\t', file=out)
+	bus = ChangeBus()
+	bus.start(paths, opts, log=out)
+	await asyncio.gather(*bus.tasks)
 
 
 def get_opts():
@@ -157,6 +478,9 @@ def get_opts():
 	parser.add_argument('-D', '--dirs', action='store_true', help="report changes to directories")
 	parser.add_argument('-i', '--inital-state', action='store_true', help="report the initial state of the files and directories")
 	parser.add_argument('-L', '--follow', action='store_true', help="follow symlinks")
+	parser.add_argument('-s', '--state-file', help="save state to this file, and on restart report only what changed since")
+	parser.add_argument('-S', '--state-interval', type=float, default=60, help="minimum seconds between saving the state")
+	parser.add_argument('-c', '--coalesce', type=float, default=0, help="merge changes to each file within this many seconds")
 	ucm.add_logging_options(parser)
 	opts = parser.parse_args()
 	return opts
@@ -5,66 +5,126 @@ import sys
 import argparse
 import logging
 import asyncio
+import heapq
+import itertools
+import weakref
 import aiofiles
 
 import ucm
 
 logger = logging.getLogger(__name__)
 
+ITEM, KEEPALIVE, DONE, ERROR = range(4)
+
+
+class KeepAliveScheduler:
+	""" Shared keepalive scheduler: one timer per event loop, with a deadline heap for all streams """
+
+	def __init__(self, loop=None):
+		""" Initialize the KeepAliveScheduler object """
+		self.loop = loop or asyncio.get_running_loop()
+		self.heap = []
+		self.seq = itertools.count()
+		self.timer = None
+		self.timer_when = None
+
+	def add(self, stream):
+		""" Start tracking a stream's deadline """
+		heapq.heappush(self.heap, (stream.deadline, next(self.seq), stream))
+		self.schedule()
+
+	def schedule(self):
+		""" Set the timer for the earliest deadline in the heap """
+		if not self.heap:
+			return
+		when = self.heap[0][0]
+		if self.timer and self.timer_when <= when:
+			return
+		if self.timer:
+			self.timer.cancel()
+		self.timer = self.loop.call_at(when, self.expire)
+		self.timer_when = when
+
+	def expire(self):
+		""" Send keepalives to streams that are past their deadlines """
+		self.timer = None
+		now = self.loop.time()
+		# Entries go stale when a stream sees activity; we don't touch the heap then,
+		# but move the stream along to its new deadline when the old one comes up.
+		while self.heap and self.heap[0][0] <= now:
+			_, _, stream = heapq.heappop(self.heap)
+			if not stream.active:
+				continue
+			if stream.deadline <= now:
+				stream.keepalive(now)
+			heapq.heappush(self.heap, (stream.deadline, next(self.seq), stream))
+		self.schedule()
+
+
+schedulers = weakref.WeakKeyDictionary()
+
+
+def get_scheduler():
+	""" Get the keepalive scheduler for the running event loop """
+	loop = asyncio.get_running_loop()
+	scheduler = schedulers.get(loop)
+	if scheduler is None:
+		scheduler = schedulers[loop] = KeepAliveScheduler(loop)
+	return scheduler
+
 
 class AsyncKeepAlive:
 	""" Async Keepalive Generator """
 
-	def __init__(self, iterable, timeout, timeout_return=None):
+	def __init__(self, iterable, timeout, timeout_return=None, scheduler=None):
 		""" Initialize the Async Keepalive Generator """
 		self.iterator = aiter(iterable)
 		self.timeout = timeout
 		self.timeout_return = timeout_return
-		self.next_item_task = None
-		self.timeout_task = None
+		self.scheduler = scheduler
+		self.queue = None
+		self.deadline = None
+		self.active = False
 
 	async def run(self):
 		""" Run the Async Keepalive Generator """
+		scheduler = self.scheduler or get_scheduler()
+		loop = scheduler.loop
+		self.queue = asyncio.Queue(maxsize=1)
+		pump_task = asyncio.create_task(self.pump())
+		self.deadline = loop.time() + self.timeout
+		self.active = True
+		scheduler.add(self)
 
 		try:
 			while True:
-				async for item in self.step():
-					yield item
-		except StopAsyncIteration:
-			pass
-
-		for task in self.next_item_task, self.timeout_task:
-			if task:
-				task.cancel()
-
-	async def step(self):
-		""" Step the Async Keepalive Generator """
-
-		if self.timeout_task is None:
-			self.timeout_task = asyncio.create_task(asyncio.sleep(self.timeout))
-		if self.next_item_task is None:
-			self.next_item_task = asyncio.create_task(anext(self.iterator))
-
-		done, _ = await asyncio.wait(
-			{ self.next_item_task,  self.timeout_task },
-			return_when=asyncio.FIRST_COMPLETED,
-		)
-
-		assert len(done) == 1
-
-		task = done.pop()
-
-		if task == self.timeout_task:
-			self.timeout_task = None
-			yield self.timeout_return
+				kind, item = await self.queue.get()
+				if kind == DONE:
+					break
+				if kind == ERROR:
+					raise item
+				if kind == ITEM:
+					self.deadline = loop.time() + self.timeout
+				yield item
+		finally:
+			self.active = False
+			pump_task.cancel()
+
+	async def pump(self):
+		""" Fetch items from the source iterator, one ahead of the consumer """
+		try:
+			async for item in self.iterator:
+				await self.queue.put((ITEM, item))
+		except Exception as e:  # pylint: disable=broad-except
+			await self.queue.put((ERROR, e))
 		else:
-			assert task == self.next_item_task
-
-			self.next_item_task = None
-			self.timeout_task.cancel()
-			self.timeout_task = None
+			await self.queue.put((DONE, None))
 
-			yield task.result()
+	def keepalive(self, now):
+		""" Called by the scheduler when the stream has been idle for the timeout """
+		self.deadline = now + self.timeout
+		if not self.queue.full():
+			self.queue.put_nowait((KEEPALIVE, self.timeout_return))
 
 
 async def async_keepalive_demo(timeout, timeout_return):
@@ -9,6 +9,8 @@ from pathlib import Path
 import asyncio
 import io
 import os
+import stat
+import collections
 
 import aiofiles
 import aionotify
@@ -19,10 +21,31 @@ import ucm
 logger = logging.getLogger(__name__)
 
 
+BLOCK_SIZE = 65536
+READ_BLOCKS = 4
+
+
+def split_lines(data):
+	""" Split bytes into complete lines of text, and the partial last line """
+	last = data.rfind(b"\n")
+	if last < 0:
+		return [], data
+	text = data[:last+1].decode("utf-8", errors="replace")
+	return [line + "\n" for line in text.split("\n")[:-1]], data[last+1:]
+
+
+def split_raw_lines(data):
+	""" Split bytes into complete lines of bytes, undecoded, and the partial last line """
+	last = data.rfind(b"\n")
+	if last < 0:
+		return [], data
+	return [line + b"\n" for line in data[:last].split(b"\n")], data[last+1:]
+
+
 class AsyncTail:
 	""" AsyncTail: a class that can tail a file asynchronously """
 
-	def __init__(self, filename="/dev/stdin", wait_for_create=False, lines=0, all_lines=False, follow=False, rewind=False):
+	def __init__(self, filename="/dev/stdin", wait_for_create=False, lines=0, all_lines=False, follow=False, rewind=False, batch=False, block_size=BLOCK_SIZE):
 		""" Initialize the AsyncTail object """
 		self.filename = filename
 		self.wait_for_create = wait_for_create
@@ -30,47 +53,108 @@ class AsyncTail:
 		self.all_lines = all_lines
 		self.follow = follow
 		self.rewind = rewind
+		self.batch = batch
+		self.block_size = block_size
+		self.partial = b""
+		self.read_count = 0
 		logger.debug("self dict: %r", self.__dict__)
 
 	async def run(self):
-		""" Tail the file """
+		""" Tail the file, yielding lines, or lists of lines in batch mode """
 		if self.wait_for_create and not Path(self.filename).exists():
 			await self.wait_for_file_creation()
 
-		async with aiofiles.open(self.filename, mode='r') as f:
-			# FIXME this is inefficient when using the n option on regular files
-			if self.all_lines or self.lines:
-				lines = await f.readlines()
-				if self.lines:
-					lines = lines[-self.lines:]
-				for line in lines:
-					yield line
+		async with aiofiles.open(self.filename, mode='rb') as f:
+			if self.lines:
+				batches = self.last_lines(f)
+			elif self.all_lines:
+				batches = self.read_available(f)
 			else:
+				batches = None
 				await self.seek_to_end(f)
 
+			if batches:
+				async for lines in batches:
+					for item in self.output(lines):
+						yield item
+
 			if self.follow:
-				async for line in self.follow_changes(f):
-					yield line
+				async for lines in self.follow_changes(f):
+					for item in self.output(lines):
+						yield item
+			elif self.partial:
+				for item in self.output([self.partial.decode("utf-8", errors="replace")]):
+					yield item
+
+	def output(self, lines):
+		""" The items to yield for some lines """
+		if self.batch:
+			return [lines]
+		return lines
+
+	async def read_available(self, f):
+		""" Read what is available in large blocks, and yield batches of complete lines """
+		while block := await f.read(self.block_size):
+			self.read_count += len(block)
+			lines, self.partial = split_lines(self.partial + block)
+			if lines:
+				yield lines
+
+	async def last_lines(self, f):
+		""" Yield the last N lines, seeking backwards from the end of the file if we can """
+		try:
+			end = await f.seek(0, 2)
+		except io.UnsupportedOperation:
+			# not seekable, so read it all, keeping only the last N lines
+			tail = collections.deque(maxlen=self.lines)
+			async for lines in self.read_available(f):
+				tail.extend(lines)
+			if self.partial and tail:
+				tail.popleft()
+			yield list(tail)
+			return
+		await f.seek(await self.last_lines_offset(f, end))
+		async for lines in self.read_available(f):
+			yield lines
+
+	async def last_lines_offset(self, f, end):
+		""" Find where the last N lines start, not counting a newline at the very end """
+		count = 0
+		pos = end - 1
+		while pos > 0:
+			block_start = max(0, pos - self.block_size)
+			await f.seek(block_start)
+			block = await f.read(pos - block_start)
+			i = len(block)
+			while (nl := block.rfind(b"\n", 0, i)) >= 0:
+				count += 1
+				if count == self.lines:
+					return block_start + nl + 1
+				i = nl
+			pos = block_start
+		return 0
 
 	async def seek_to_end(self, f):
+		""" Go to the end of the file, if it is seekable, and return the new position """
 		try:
-			await f.seek(0, 2)
+			return await f.seek(0, 2)
 		except io.UnsupportedOperation:
-			pass
+			return None
 
 	async def follow_changes(self, f):
-		""" Follow the file """
+		""" Follow the file, yielding batches of lines """
 		try:
 			watcher = aionotify.Watcher()
 			watcher.watch(self.filename, aionotify.Flags.MODIFY)
 			await watcher.setup(asyncio.get_event_loop())
 			while True:
-				count = 0
-				while line := await f.readline():
-					yield line
-					count += 1
-				if self.rewind and not count:
-					await self.seek_to_end(f)
+				self.read_count = 0
+				async for lines in self.read_available(f):
+					yield lines
+				if self.rewind and not self.read_count:
+					pos = await f.tell()
+					if await self.seek_to_end(f) not in (None, pos):
+						self.partial = b""
 				await watcher.get_event()
 		finally:
 			self.close_watcher(watcher)
@@ -94,12 +178,208 @@ class AsyncTail:
 			logger.warning("Exception closing watcher: %r", e)
 
 
+class TailReader:  # pylint: disable=too-few-public-methods
+	""" TailReader: one consumer's position in a file tailed by MultiTail
+
+	With raw, lines are (offset, data) pairs of each line's byte offset in the
+	file and its undecoded bytes.  If the file shrinks, with rewind, an empty
+	line at the new end says where the following lines start.
+	"""
+
+	def __init__(self, filename, rewind=False, raw=False, block_size=BLOCK_SIZE):
+		""" Initialize the TailReader object """
+		self.filename = filename
+		self.rewind = rewind
+		self.raw = raw
+		self.fd = os.open(filename, os.O_RDONLY | os.O_NONBLOCK)
+		self.regular = stat.S_ISREG(os.fstat(self.fd).st_mode)
+		self.buf = bytearray(block_size)
+		self.partial = b""
+		self.offset = 0
+		self.eof = False
+		self.more = False
+		self.ready = asyncio.Event()
+
+	def seek_to_end(self):
+		""" Go to the end of the file, if it is seekable """
+		if self.regular:
+			self.offset = os.lseek(self.fd, 0, os.SEEK_END)
+
+	def seek_to_last_lines(self, n):
+		""" Go to the start of the last n lines, not counting a newline at the very end, reading back from the end """
+		if not self.regular:
+			return
+		block_size = len(self.buf)
+		count = 0
+		pos = os.lseek(self.fd, 0, os.SEEK_END) - 1
+		start = 0
+		while pos > 0 and not start:
+			block_start = max(0, pos - block_size)
+			block = os.pread(self.fd, pos - block_start, block_start)
+			i = len(block)
+			while (nl := block.rfind(b"\n", 0, i)) >= 0:
+				count += 1
+				if count == n:
+					start = block_start + nl + 1
+					break
+				i = nl
+			pos = block_start
+		self.offset = os.lseek(self.fd, start, os.SEEK_SET)
+
+	def read_lines(self, max_blocks=READ_BLOCKS):
+		""" Read up to max_blocks of what is available into the reusable buffer, and return the complete lines.
+		If there might be more to read, more is set, so the caller can let others run before reading again. """
+		lines = []
+		count = 0
+		split = split_raw_lines if self.raw else split_lines
+		self.more = False
+		for _ in range(max_blocks):
+			try:
+				n = os.readv(self.fd, [self.buf])
+			except BlockingIOError:
+				break
+			if n == 0:
+				self.eof = not self.regular
+				break
+			count += n
+			new_lines, self.partial = split(self.partial + self.buf[:n])
+			lines.extend(new_lines)
+		else:
+			self.more = True
+		if self.eof and self.partial:
+			lines.append(self.partial if self.raw else self.partial.decode("utf-8", errors="replace"))
+			self.partial = b""
+		if self.raw:
+			lines = self.with_offsets(lines)
+		if self.rewind and not count and self.regular and os.fstat(self.fd).st_size < os.lseek(self.fd, 0, os.SEEK_CUR):
+			logger.debug("file shrank, going to the new end: %s", self.filename)
+			self.seek_to_end()
+			self.partial = b""
+			if self.raw:
+				lines.append((self.offset, b""))
+		return lines
+
+	def with_offsets(self, lines):
+		""" Pair raw lines with their byte offsets in the file """
+		result = []
+		for line in lines:
+			result.append((self.offset, line))
+			self.offset += len(line)
+		return result
+
+	def close(self):
+		""" Close the file """
+		os.close(self.fd)
+
+
+class MultiTail:
+	""" MultiTail: tail many files through one inotify instance, reading with non-blocking os.read """
+
+	def __init__(self):
+		""" Initialize the MultiTail object """
+		self.watcher = aionotify.Watcher()
+		self.watches = {}
+		self.readers = {}
+		self.waiting = {}
+		self.setup_task = None
+		self.task = None
+
+	async def setup(self):
+		""" Start the inotify watcher, and the task that dispatches its events """
+		if self.setup_task is None:
+			self.setup_task = asyncio.ensure_future(self.watcher.setup(asyncio.get_running_loop()))
+		await self.setup_task
+		if self.task is None:
+			self.task = asyncio.create_task(self.dispatch())
+
+	async def dispatch(self):
+		""" Wake up the readers and waiters for each inotify event """
+		while event := await self.watcher.get_event():
+			if event.name:
+				for waiter in self.waiting.get(os.path.join(event.alias, event.name), ()):
+					waiter.set()
+			else:
+				for reader in self.readers.get(event.alias, ()):
+					reader.ready.set()
+
+	def watch(self, path, flags):
+		""" Watch a path, shared with other users of the same path """
+		if path not in self.watches:
+			self.watcher.watch(path, flags, alias=path)
+			self.watches[path] = 0
+		self.watches[path] += 1
+
+	def unwatch(self, path):
+		""" Stop watching a path, when no one else is using it """
+		self.watches[path] -= 1
+		if not self.watches[path]:
+			del self.watches[path]
+			try:
+				self.watcher.unwatch(path)
+			except (ValueError, IOError) as e:
+				logger.warning("Exception removing watch: %r", e)
+
+	async def tail(self, filename, wait_for_create=False, lines=0, all_lines=False, rewind=False, raw=False):
+		""" Follow a file, yielding lines as they are added, or (offset, data) pairs with raw, see TailReader """
+		await self.setup()
+		if wait_for_create:
+			await self.wait_for_file_creation(filename)
+		reader = TailReader(filename, rewind=rewind, raw=raw)
+		if lines:
+			reader.seek_to_last_lines(lines)
+		elif not all_lines:
+			reader.seek_to_end()
+		loop = asyncio.get_running_loop()
+		if reader.regular:
+			self.watch(filename, aionotify.Flags.MODIFY)
+			self.readers.setdefault(filename, set()).add(reader)
+		else:
+			loop.add_reader(reader.fd, reader.ready.set)
+		try:
+			while not reader.eof:
+				reader.ready.clear()
+				for line in reader.read_lines():
+					yield line
+				if reader.more:
+					# let others run before reading the rest
+					await asyncio.sleep(0)
+				elif not reader.eof:
+					await reader.ready.wait()
+		finally:
+			if reader.regular:
+				self.readers[filename].discard(reader)
+				if not self.readers[filename]:
+					del self.readers[filename]
+				self.unwatch(filename)
+			else:
+				loop.remove_reader(reader.fd)
+			reader.close()
+
+	async def wait_for_file_creation(self, filename):
+		""" Wait for a file to be created """
+		folder = str(Path(filename).parent)
+		waiter = asyncio.Event()
+		self.waiting.setdefault(filename, set()).add(waiter)
+		self.watch(folder, aionotify.Flags.CREATE | aionotify.Flags.MOVED_TO)
+		try:
+			while not Path(filename).exists():
+				await waiter.wait()
+				waiter.clear()
+		finally:
+			self.waiting[filename].discard(waiter)
+			if not self.waiting[filename]:
+				del self.waiting[filename]
+			self.unwatch(folder)
+
+
+multi = MultiTail()
+
 
 async def atail(output=sys.stdout, filename="/dev/stdin", wait_for_create=False, lines=0, all_lines=False, follow=False, rewind=False):
 	""" Tail a file - for command-line tool, and an example of usage """
-	tail = AsyncTail(filename=filename, wait_for_create=wait_for_create, lines=lines, all_lines=all_lines, follow=follow, rewind=rewind).run()
-	async for line in tail:
-		print(line, end='', file=output)
+	tail = AsyncTail(filename=filename, wait_for_create=wait_for_create, lines=lines, all_lines=all_lines, follow=follow, rewind=rewind, batch=True).run()
+	async for batch in tail:
+		output.write("".join(batch))
 		output.flush()
 
 
@@ -80,22 +80,79 @@ def add_newline(lines):
 	""" add a newlines to the end of the lines """
 	return map(lambda line: line + "\n", lines)
 
+def common_prefix_length(a, b):
+	""" return the length of the common prefix of two strings """
+	n = min(len(a), len(b))
+	for i in range(n):
+		if a[i] != b[i]:
+			return i
+	return n
+
+def scan_indents(lines):
+	""" strip trailing whitespace, and find the common indent and the indent unit, in one pass """
+	stripped = []
+	indents = []
+	common = None  # common indent of the non-blank lines
+	unit = None    # common indent beyond that, of lines indented further
+	level = False  # is some line indented exactly to the common indent?
+	for line in lines:
+		line = line.rstrip()
+		stripped.append(line)
+		if not line:
+			indents.append("")
+			continue
+		indent = line[:len(line) - len(line.lstrip())]
+		indents.append(indent)
+		if common is None:
+			common = indent
+			level = True
+			continue
+		if not indent.startswith(common):
+			# the common indent shrinks, so earlier lines are now indented further
+			k = common_prefix_length(common, indent)
+			extra = common[k:]
+			unit = extra if level or unit is None else extra + unit
+			common = common[:k]
+			level = False
+		rest = indent[len(common):]
+		if not rest:
+			level = True
+		elif unit is None:
+			unit = rest
+		elif not rest.startswith(unit):
+			unit = unit[:common_prefix_length(unit, rest)]
+	return stripped, indents, common or "", unit or ""
+
 def fix_indentation_list(lines, tab):
 	""" fix the indentation of the lines """
-
-	lines = rstrip_lines(lines)
-	lines = strip_common_indent(lines)
-
-	tab_old = get_tab_string(lines)
+	lines, indents, common, tab_old = scan_indents(lines)
+	n = len(common)
 
 	if not tab_old:
 		logging.debug("No indentation found")
-	elif tab_old != tab:
-		lines = map(lambda line: replace_indentation(line, tab_old, tab), lines)
-
-	lines = add_newline(lines)
-
-	return lines
+	if not tab_old or tab_old == tab:
+		return [line[n:] + "\n" for line in lines]
+
+	m = len(tab_old)
+	output = []
+	for line, indent in zip(lines, indents):
+		indent = indent[n:]
+		if not indent:
+			output.append(line[n:] + "\n")
+			continue
+		indent_len = len(indent) // m
+		if indent != tab_old * indent_len:
+			logging.info("Inconsistent indentation: " + repr(line[n:]))
+			output.append(line[n:] + "\n")
+			continue
+		output.append(tab * indent_len + line[n + len(indent):] + "\n")
+	return output
+
+def test_fix_indentation_list():
+	""" test fix_indentation_list """
+	assert fix_indentation_list(['  if x:', '    y', '', '  z  '], '\t') == ['if x:\n', '\ty\n', '\n', 'z\n']
+	assert fix_indentation_list(['    a', '  b', '      c'], '\t') == ['\ta\n', 'b\n', '\t\tc\n']
+	assert fix_indentation_list(['a', '\t b', '\t\t c'], '  ') == ['a\n', '\t b\n', '\t\t c\n']
 
 @argh.arg('-c', help='character to use for tab')
 def fix_indentation(inp: IO[str]=stdin, out: IO[str]=stdout, n=1, c='\t', tab=None):
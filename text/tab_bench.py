@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+""" tab_bench.py: benchmark tab.fix_indentation_list on large code responses, and check it against the old multi-pass version """
+
+import sys
+import argparse
+import logging
+import random
+import time
+
+import ucm
+import tab
+
+
+logger = logging.getLogger(__name__)
+
+INDENTS = ["\t", "  ", "    ", " ", "\t ", "\u00a0", "\u3000"]
+
+WORDS = "if for while return def class import print x y z foo bar baz = + - ( ) [ ] : ,".split()
+
+
+def fix_indentation_list_multipass(lines, tab_string):
+	""" the old implementation of tab.fix_indentation_list, for reference """
+	lines = tab.rstrip_lines(lines)
+	lines = tab.strip_common_indent(lines)
+
+	tab_old = tab.get_tab_string(lines)
+
+	if not tab_old:
+		logging.debug("No indentation found")
+	elif tab_old != tab_string:
+		lines = map(lambda line: tab.replace_indentation(line, tab_old, tab_string), lines)
+
+	lines = tab.add_newline(lines)
+
+	return lines
+
+
+def code_response(rng, n_lines, indent="    ", base=0, messy=0.0):
+	""" generate some code-like lines, with nested indentation """
+	lines = []
+	depth = 0
+	for _ in range(n_lines):
+		if rng.random() < 0.05:
+			lines.append(rng.choice(["", "  ", "\t"]))
+			continue
+		depth = max(0, min(8, depth + rng.choice([-1, 0, 0, 1])))
+		prefix = indent * (base + depth)
+		if rng.random() < messy:
+			prefix = "".join(rng.choice(INDENTS) for _ in range(rng.randint(0, 3))) + prefix
+		words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+		lines.append(prefix + words + rng.choice(["", " ", "\t", "  "]))
+	return lines
+
+
+def fuzz_lines(rng):
+	""" some short lines of random whitespace and text """
+	chars = ["\t", " ", "\u00a0", "\u3000", "\x0b", "\x1c", "a", "b", "\n"]
+	return ["".join(rng.choice(chars) for _ in range(rng.randint(0, 6))) for _ in range(rng.randint(0, 6))]
+
+
+def check(rng, iterations, n_lines):
+	""" compare the new and old implementations on random input; return the number of mismatches """
+	failures = 0
+	for i in range(iterations):
+		if i % 2:
+			lines = fuzz_lines(rng)
+		else:
+			lines = code_response(rng, rng.randint(0, n_lines), indent=rng.choice(INDENTS), base=rng.randint(0, 2), messy=rng.choice([0, 0.1]))
+		tab_string = rng.choice(["\t", "  ", "    "])
+		expected = list(fix_indentation_list_multipass(lines, tab_string))
+		actual = list(tab.fix_indentation_list(lines, tab_string))
+		if expected != actual:
+			failures += 1
+			if failures <= 5:
+				logger.error("mismatch for %r, tab %r:\nexpected %r\nactual   %r", lines, tab_string, expected, actual)
+	return failures
+
+
+def bench(fn, lines, repeat):
+	""" the best time of fn over the lines """
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		list(fn(lines, "\t"))
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+
+def tab_bench(opts, out=sys.stdout):
+	""" check the implementations agree, then time them """
+	rng = random.Random(opts.seed)
+	failures = check(rng, opts.check, 50)
+	logger.info("check: %d of %d mismatched", failures, opts.check)
+
+	print("input", "lines", "old", "new", "speedup", sep="\t", file=out)
+	for name, messy in ("clean", 0.0), ("messy", 0.1):
+		lines = code_response(rng, opts.lines, base=1, messy=messy)
+		old = bench(fix_indentation_list_multipass, lines, opts.repeat)
+		new = bench(tab.fix_indentation_list, lines, opts.repeat)
+		print(name, len(lines), f"{old:.4f}", f"{new:.4f}", f"{old / new:.2f}", sep="\t", file=out)
+	return failures
+
+
+def get_opts():
+	""" Get the command line options """
+	parser = argparse.ArgumentParser(description="tab_bench: benchmark tab.fix_indentation_list", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('-n', '--lines', type=int, default=20000, help="number of lines in each code response")
+	parser.add_argument('-r', '--repeat', type=int, default=5, help="repeat each run, and report the best time")
+	parser.add_argument('-c', '--check', type=int, default=2000, help="number of random inputs to compare with the old implementation")
+	parser.add_argument('-S', '--seed', type=int, default=0, help="random seed")
+	ucm.add_logging_options(parser)
+	opts = parser.parse_args()
+	return opts
+
+
+def main():
+	""" Main function """
+	opts = get_opts()
+	ucm.setup_logging(opts)
+	failures = tab_bench(opts)
+	sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+	main()
@@ -10,8 +10,9 @@ from pathlib import Path
 from watchfiles import Change
 
 import ucm
-import atail
+import awatch
 import chat
+import room_archive
 
 
 logger = logging.getLogger(__name__)
@@ -25,21 +26,18 @@ class BB2HTMLOptions: # pylint: disable=too-few-public-methods
 class BB2HTML:
 	""" convert bb files to html as they change """
 
-	def __init__(self, opts, watch_log):
+	def __init__(self, opts, watch_log=None, changes=None):
 		""" Initialize the BB2HTML object """
 		self.opts = opts
 		self.watch_log = watch_log
-		self.tail = atail.AsyncTail(filename=self.watch_log, follow=True, rewind=True).run()
+		self.changes = changes or awatch.changes_from_log(self.watch_log)
 
 	async def run(self):
 		""" convert bb files to html as they change """
 		logger.debug("opts: %s", self.opts)
-		async for line in self.tail:
-			logger.debug("line from tail: %s", line)
-			bb_file, change_type, old_size, new_size = line.rstrip("\n").split("\t")
-			change_type = Change(int(change_type))
-			old_size = int(old_size) if old_size != "" else None
-			new_size = int(new_size) if new_size != "" else None
+		async for change in self.changes:
+			logger.debug("change: %s", change)
+			bb_file, change_type, old_size, new_size = change
 			if not bb_file.endswith(self.opts.exts):
 				continue
 			html_file = str(Path(bb_file).with_suffix(".html"))
@@ -55,13 +53,15 @@ class BB2HTML:
 	async def file_changed(self, bb_file, html_file, old_size, new_size):
 		""" convert a bb file to html """
 
-		# assume the file was appended to ...
-		html_file_mode = "ab"
-
-		# ... unless the file has shrunk
+		# if the file has shrunk, it was compacted or rewritten
 		if old_size and new_size < old_size:
-			logger.warning("bb file was truncated: %s from %s to %s", bb_file, old_size, new_size)
-			html_file_mode = "wb"
+			logger.info("bb file shrank: %s from %s to %s", bb_file, old_size, new_size)
+			self.rebuild(bb_file, html_file)
+			yield [html_file]
+			return
+
+		# otherwise assume the file was appended to
+		html_file_mode = "ab"
 
 		with open(bb_file, "rb") as bb:
 			with open(html_file, html_file_mode) as html:
@@ -73,10 +73,32 @@ class BB2HTML:
 				row = [html_file]
 				yield row
 
+	def rebuild(self, bb_file, html_file):
+		""" convert the full history of a bb file to html, including archived messages
+
+		When a room is compacted the html is the same, so it is left alone,
+		and followers of the html file are not disturbed.
+		"""
+		lines = room_archive.history_lines(bb_file)
+		html_data = b"".join(chat.message_to_html(message).encode("utf-8") for message in chat.lines_to_messages(lines))
+		try:
+			with open(html_file, "rb") as html:
+				old_data = html.read()
+		except FileNotFoundError:
+			old_data = None
+		if old_data is not None and html_data.startswith(old_data):
+			with open(html_file, "ab") as html:
+				html.write(html_data[len(old_data):])
+			return
+		logger.warning("bb file was rewritten: %s", bb_file)
+		with open(html_file, "wb") as html:
+			html.write(html_data)
+
 
 async def bb2html_main(opts, watch_log, out=sys.stdout):
 	""" Main function """
-	bb2html = BB2HTML(opts=opts, watch_log=watch_log)
+	changes = awatch.subscribe_changes(watch_log, opts.paths, awatch.watcher_options(exts=opts.exts, coalesce=opts.coalesce), opts.changes_log)
+	bb2html = BB2HTML(opts=opts, changes=changes)
 	async for row in bb2html.run():
 		print(*row, sep="\t", file=out)
 
@@ -86,6 +108,9 @@ def get_opts():
 	parser = argparse.ArgumentParser(description="bb2html: convert bb files to html as they change", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 	parser.add_argument('-w', '--watch-log', default="/dev/stdin", help="the file where changes are logged")
 	parser.add_argument('-x', '--extension', nargs="*", default=("bb",), help="the file extensions to process")
+	parser.add_argument('-p', '--paths', nargs="*", help="watch these paths in this process, instead of reading the changes log")
+	parser.add_argument('-o', '--changes-log', type=argparse.FileType("a"), help="with --paths, also log the changes to this file")
+	parser.add_argument('-c', '--coalesce', type=float, default=0, help="with --paths, merge changes to each file within this many seconds")
 	ucm.add_logging_options(parser)
 	opts = parser.parse_args()
 	return opts
@@ -4,6 +4,7 @@
 
 import os
 from pathlib import Path
+import asyncio
 
 from starlette.applications import Starlette
 from starlette.requests import Request
@@ -17,6 +18,8 @@ import chat
 ADMINS = os.environ.get("ALLYCHAT_ADMINS", "").split()
 ROOMS = "rooms"
 EXTENSION = ".bb"
+ROOMS_DIR = Path(ROOMS).resolve()
+WRITERS_MAX = 100
 
 
 async def http_exception(_request: Request, exc: HTTPException):
@@ -46,19 +49,99 @@ async def whoami(request):
 	return JSONResponse({"user": user, "room": room, "admin": admin, "mod": mod})
 
 
-def write_to_room(room, user, content):
+class RoomWriter:
+	""" Append messages to a room file, coalescing concurrent posts into single locked writes """
+
+	def __init__(self, path):
+		""" Initialize the RoomWriter object """
+		self.path = path
+		self.fd = None
+		self.pending = []
+		self.flushing = None
+
+	async def write(self, text):
+		""" Queue a message, and wait until it has been written """
+		future = asyncio.get_running_loop().create_future()
+		self.pending.append((text, future))
+		if self.flushing is None:
+			self.flushing = asyncio.create_task(self.flush())
+		await future
+
+	async def flush(self):
+		""" Write out pending messages; posts that arrive meanwhile go in the next batch """
+		try:
+			while self.pending:
+				batch, self.pending = self.pending, []
+				data = "".join(text for text, _future in batch).encode("utf-8")
+				error = None
+				try:
+					await asyncio.to_thread(self.append, data)
+				except Exception as ex:  # pylint: disable=broad-except
+					error = ex
+				for _text, future in batch:
+					if future.done():
+						continue
+					if error:
+						future.set_exception(error)
+					else:
+						future.set_result(None)
+		finally:
+			self.flushing = None
+
+	def append(self, data):
+		""" Append data to the file in one write, holding the lock """
+		self.open()
+		with chat.file_lock(self.fd):
+			view = memoryview(data)
+			while view:
+				view = view[os.write(self.fd, view):]
+
+	def open(self):
+		""" Open the file, or reopen it if it was moved or deleted, e.g. by room-rotate """
+		if self.fd is not None:
+			try:
+				if os.stat(self.path).st_ino == os.fstat(self.fd).st_ino:
+					return
+			except FileNotFoundError:
+				pass
+			self.close()
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+
+	def close(self):
+		""" Close the file """
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+
+writers = {}
+
+
+def get_room_writer(path):
+	""" Get the writer for a room file, closing the least recently used idle writer if there are too many """
+	writer = writers.pop(path, None)
+	if writer is None:
+		writer = RoomWriter(path)
+		if len(writers) >= WRITERS_MAX:
+			idle = next((w for w in writers.values() if w.flushing is None), None)
+			if idle:
+				idle.close()
+				del writers[idle.path]
+	writers[path] = writer
+	return writer
+
+
+async def write_to_room(room, user, content):
 	""" Write a message to a room. """
 	assert isinstance(room, str)
 	assert not room.startswith("/")
 	assert not room.endswith("/")
-	base_dir = Path(ROOMS).resolve()
-	markdown_file = chat.safe_join(base_dir, room + EXTENSION)
-	# html_file = chat.safe_join(base_dir, room+".html")
-	dirname = Path(markdown_file).parent
-	dirname.mkdir(parents=True, exist_ok=True)
+	markdown_file = chat.safe_join(ROOMS_DIR, room + EXTENSION)
 
 	if content == "":
 		# touch the markdown_file, to poke some attention
+		markdown_file.parent.mkdir(parents=True, exist_ok=True)
 		markdown_file.touch()
 		return
 
@@ -71,8 +154,7 @@ def write_to_room(room, user, content):
 
 	text = chat.message_to_text(message)
 
-	with markdown_file.open("a", encoding="utf-8") as f:
-		f.write(text)
+	await get_room_writer(markdown_file).write(text)
 
 	# TODO don't convert to HTML here, a follower process will do that
 
@@ -90,7 +172,7 @@ async def post(request):
 	content = form["content"]
 	user = request.headers['X-Forwarded-User']
 	try:
-		write_to_room(room, user, content)
+		await write_to_room(room, user, content)
 	except PermissionError:
 		raise HTTPException(status_code=403, detail="You are not allowed to post to this room.")
 	return JSONResponse({})
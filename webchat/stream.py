@@ -5,13 +5,22 @@
 import os
 import logging
 from pathlib import Path
+import asyncio
+import collections
+import bisect
+import itertools
+import zlib
+import struct
 
 from starlette.applications import Starlette
 from starlette.responses import StreamingResponse
+from starlette.exceptions import HTTPException
 from starlette.templating import Jinja2Templates
 import uvicorn
+import aiofiles
 
 import chat
+import room_archive
 import atail
 import akeepalive
 
@@ -22,6 +31,20 @@ logger = logging.getLogger(__name__)
 
 FOLLOW_KEEPALIVE = 50
 HTML_KEEPALIVE = "<script>online()</script>\n"
+HUB_RING_SIZE = 1000
+READ_BLOCK_SIZE = 65536
+SEND_BLOCK_SIZE = 1048576
+ZEROCOPY_SEND = "http.response.zerocopysend"
+HTML_MESSAGE_STARTS = (b'<div class="message"', b'<div class="narrative"')
+BB_CONTINUATION_STARTS = (b"\t", b" ", b"\r", b"\n")
+
+# gzip compression level for each media type, 0 or missing for none
+COMPRESS_LEVELS = {
+	"text/html": 6,
+	"text/plain": 6,
+}
+HISTORY_CACHE_SIZE = 64 * 1048576
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
 
 
 BASE_DIR = Path(".").resolve()
@@ -58,22 +81,456 @@ app = Starlette(
 )
 
 
-async def follow(file, head="", keepalive=FOLLOW_KEEPALIVE, keepalive_string="\n"):
-	""" Follow a file and yield new lines as they are added. """
+class FileHub:
+	""" FileHub: one tailer per file, fanned out to many followers through a ring buffer of recent lines
+
+	The ring holds the raw bytes of each line with its offset in the full
+	history, so followers can start at any exact offset.  The live file
+	starts at base, after the archived history, see room_archive.py.
+	If the file is compacted, the offsets still hold.  If it is otherwise
+	truncated, the ring is cleared and the followers go on from the new end.
+	"""
+
+	def __init__(self, filename, ring_size=HUB_RING_SIZE):
+		""" Initialize the FileHub object """
+		self.filename = filename
+		self.ring = collections.deque(maxlen=ring_size)
+		self.base = archived_base(filename)
+		self.offset = self.base
+		self.resets = 0
+		self.changed = asyncio.Event()
+		self.followers = 0
+		self.task = None
+
+	def start(self):
+		""" Start tailing the file """
+		self.task = asyncio.create_task(self.run())
+
+	def stop(self):
+		""" Stop tailing the file """
+		if self.task:
+			self.task.cancel()
+			self.task = None
+
+	async def run(self):
+		""" Tail the file into the ring buffer, and wake up the followers """
+		# start with the last lines, to fill the ring; followers read anything older from the file
+		tail = atail.multi.tail(self.filename, wait_for_create=True, lines=self.ring.maxlen, rewind=True, raw=True)
+		async for offset, data in tail:
+			if self.base + offset != self.offset:
+				self.moved(offset)
+			if data:
+				self.ring.append((self.offset, data))
+				self.offset += len(data)
+			self.wake()
+
+	def wake(self):
+		""" Wake up the followers """
+		self.changed.set()
+		self.changed = asyncio.Event()
+
+	def moved(self, live_offset):
+		""" The file shrank, or the tailer skipped ahead, so the live file is at a new offset """
+		base = archived_base(self.filename)
+		offset = base + live_offset
+		self.base = base
+		if offset < self.offset:
+			# truncated, not compacted
+			logger.info("hub reset: %s from %d to %d, base %d", self.filename, self.offset, offset, base)
+			self.ring.clear()
+			self.resets += 1
+		elif offset > self.offset:
+			# starting from the last lines, or skipped ahead; followers read the gap from the file
+			logger.debug("hub moved: %s from %d to %d, base %d", self.filename, self.offset, offset, base)
+			self.ring.clear()
+		self.offset = offset
+
+	def check_size(self):
+		""" Catch up if the file shrank, before the tailer notices """
+		try:
+			size = os.stat(self.filename).st_size
+		except FileNotFoundError:
+			return
+		if self.base + size < self.offset:
+			self.moved(size)
+			self.wake()
+
+	def ring_start(self):
+		""" The file offset of the oldest line in the ring buffer """
+		if self.ring:
+			return self.ring[0][0]
+		return self.offset
+
+	async def follow(self, start=0):
+		""" Yield the file from the start offset, then new lines as they are added.
+
+		A follower that falls behind the ring buffer is not a burden on the
+		hub: it catches up by reading the missed range from the file itself.
+		"""
+		self.check_size()
+		pos = start
+		resets = self.resets
+		while True:
+			changed = self.changed
+			if resets != self.resets:
+				# the file shrank, so what we had is gone; go on from the new end
+				resets = self.resets
+				pos = self.ring_start()
+			ring_start = self.ring_start()
+			if pos < ring_start:
+				async for data in read_history(self.filename, self.base, pos, ring_start):
+					yield data
+				pos = ring_start
+			elif pos < self.offset:
+				i = bisect.bisect_right(self.ring, pos, key=lambda entry: entry[0]) - 1
+				entries = list(itertools.islice(self.ring, i, None))
+				entry_offset, data = entries[0]
+				if entry_offset < pos:
+					# start part way through a line, at the exact offset
+					entries[0] = pos, data[pos - entry_offset:]
+				pos = self.offset
+				for _offset, data in entries:
+					yield data
+			else:
+				await changed.wait()
+
+
+hubs = {}
+
+
+def hub_acquire(filename):
+	""" Get the hub for a file, starting it if needed """
+	hub = hubs.get(filename)
+	if hub is None:
+		hub = hubs[filename] = FileHub(filename)
+		hub.start()
+		logger.info("hub started: %s", filename)
+	hub.followers += 1
+	return hub
+
+
+def hub_release(hub):
+	""" Release a hub, stopping it when it has no more followers """
+	hub.followers -= 1
+	if hub.followers == 0:
+		hub.stop()
+		del hubs[hub.filename]
+		logger.info("hub stopped: %s", hub.filename)
+
+
+def archived_base(filename):
+	""" The offset of the live file in the full history, after the archived history of a bb file """
+	if Path(filename).suffix != ".bb":
+		return 0
+	return room_archive.archived_size(filename)
+
+
+def history_size(filename):
+	""" The archived size, full size and mtime of a file's history, read under a shared lock so a compaction can't come between them """
+	try:
+		with open(filename, "rb") as f:
+			with chat.file_lock(f, shared=True):
+				base = archived_base(filename)
+				stat = os.fstat(f.fileno())
+	except FileNotFoundError:
+		return 0, 0, 0
+	return base, base + stat.st_size, stat.st_mtime_ns
+
+
+async def read_history(filename, base, start, end, block_size=READ_BLOCK_SIZE):
+	""" Read a range of the full history in blocks, from the archive before base, then the live file.
+	If the file is compacted meanwhile, we go on from the archive with the new base. """
+	if start < base:
+		blocks = room_archive.history_blocks(filename, start=start, end=min(end, base), block_size=block_size, live=False)
+		while block := await asyncio.to_thread(next, blocks, None):
+			yield block
+		start = base
+	async with aiofiles.open(filename, mode="rb") as f:
+		await f.seek(start - base)
+		pos = start
+		while pos < end:
+			block = await f.read(min(block_size, end - pos))
+			new_base = archived_base(filename)
+			if new_base != base:
+				logger.debug("compacted while reading: %s, base %d to %d", filename, base, new_base)
+				async for block in read_history(filename, new_base, pos, end, block_size=block_size):
+					yield block
+				return
+			if not block:
+				break
+			pos += len(block)
+			yield block
+
+
+def is_message_start(data, i, ext):
+	""" Check if a line starting at data[i] starts a new message """
+	if ext == ".html":
+		return data.startswith(HTML_MESSAGE_STARTS, i)
+	return i < len(data) and not data.startswith(BB_CONTINUATION_STARTS, i)
+
+
+async def last_messages_offset(filename, n, end=None):
+	""" Find the offset where the last n messages before end start, scanning backwards from end """
+	ext = Path(filename).suffix
+	try:
+		size = os.stat(filename).st_size
+	except FileNotFoundError:
+		return 0
+	if end is None or end > size:
+		end = size
+	count = 0
+	carry = b""
+	pos = end
+	async with aiofiles.open(filename, mode="rb") as f:
+		while pos > 0:
+			block_start = max(0, pos - READ_BLOCK_SIZE)
+			await f.seek(block_start)
+			data = await f.read(pos - block_start) + carry
+			pos = block_start
+			i = len(data)
+			while (nl := data.rfind(b"\n", 0, i)) >= 0:
+				start = block_start + nl + 1
+				if start < end and is_message_start(data, nl + 1, ext):
+					count += 1
+					if count == n:
+						return start
+				i = nl
+			carry = data[:i]
+	return 0
+
+
+def get_int_param(request, name, header=None):
+	""" Get a non-negative integer query parameter, or header """
+	value = request.query_params.get(name)
+	if value is None and header:
+		value = request.headers.get(header)
+	if value is None or value == "":
+		return None
+	try:
+		value = int(value)
+	except ValueError as ex:
+		raise HTTPException(status_code=400, detail=f"Invalid {name}: {value}") from ex
+	if value < 0:
+		raise HTTPException(status_code=400, detail=f"Invalid {name}: {value}")
+	return value
+
+
+async def follow(file, head="", start=0, keepalive=FOLLOW_KEEPALIVE, keepalive_string="\n"):
+	""" Follow a file from the start offset, and yield new lines as they are added. """
 
 	if head:
 		yield head
 
-	tail = atail.AsyncTail(filename=file, wait_for_create=True, all_lines=True, follow=True, rewind=True).run()
-	tail2 = akeepalive.AsyncKeepAlive(tail, keepalive, timeout_return=keepalive_string).run()
-
-	async for line in tail2:
-		yield line
+	hub = hub_acquire(file)
+	try:
+		tail = hub.follow(start=start)
+		tail2 = akeepalive.AsyncKeepAlive(tail, keepalive, timeout_return=keepalive_string).run()
+
+		async for line in tail2:
+			yield line
+	finally:
+		hub_release(hub)
+
+
+CompressedHistory = collections.namedtuple("CompressedHistory", "data comp crc size")
+
+history_cache = collections.OrderedDict()
+
+
+def deflater(level):
+	""" A raw deflate compressor, for the body of a gzip stream """
+	return zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+
+def compress_range(filename, start, end, level):
+	""" Compress a range of the full history of a file, ready to continue compressing after it """
+	comp = deflater(level)
+	parts = []
+	crc = 0
+	size = 0
+	for block in room_archive.history_blocks(filename, start=start, end=end, block_size=SEND_BLOCK_SIZE):
+		size += len(block)
+		crc = zlib.crc32(block, crc)
+		parts.append(comp.compress(block))
+	parts.append(comp.flush(zlib.Z_SYNC_FLUSH))
+	return CompressedHistory(b"".join(parts), comp, crc, size)
+
+
+async def compressed_history(filename, start, end, mtime_ns, level):
+	""" Compress a range of the full history of a file once, and share it among followers until the file changes """
+	key = (filename, start, end, mtime_ns, level)
+	task = history_cache.pop(key, None)
+	if task is None:
+		task = asyncio.ensure_future(asyncio.to_thread(compress_range, filename, start, end, level))
+	history_cache[key] = task
+	try:
+		history = await task
+	except Exception:
+		history_cache.pop(key, None)
+		raise
+	trim_history_cache()
+	return history
+
+
+def trim_history_cache():
+	""" Drop the least recently used compressed history, to keep the cache within its size """
+	done = [(key, task) for key, task in history_cache.items() if task.done() and not task.exception()]
+	total = sum(len(task.result().data) for _key, task in done)
+	for key, task in done:
+		if total <= HISTORY_CACHE_SIZE:
+			break
+		total -= len(task.result().data)
+		del history_cache[key]
+
+
+def gf2_matrix_times(mat, vec):
+	""" Multiply a GF(2) matrix by a vector, for crc32_combine """
+	total = 0
+	i = 0
+	while vec:
+		if vec & 1:
+			total ^= mat[i]
+		vec >>= 1
+		i += 1
+	return total
+
+
+def gf2_matrix_square(mat):
+	""" Square a GF(2) matrix, for crc32_combine """
+	return [gf2_matrix_times(mat, mat[n]) for n in range(32)]
+
+
+def crc32_combine(crc1, crc2, len2):
+	""" Combine the CRC-32 of two pieces of data, as in zlib which Python doesn't expose """
+	if len2 == 0:
+		return crc1
+	odd = [0xedb88320] + [1 << n for n in range(31)]
+	even = gf2_matrix_square(odd)
+	odd = gf2_matrix_square(even)
+	while True:
+		even = gf2_matrix_square(odd)
+		if len2 & 1:
+			crc1 = gf2_matrix_times(even, crc1)
+		len2 >>= 1
+		if not len2:
+			break
+		odd = gf2_matrix_square(even)
+		if len2 & 1:
+			crc1 = gf2_matrix_times(odd, crc1)
+		len2 >>= 1
+		if not len2:
+			break
+	return crc1 ^ crc2
+
+
+class RoomResponse(StreamingResponse):
+	""" Send a range of a file as is, then follow it
+
+	The history is sent with the ASGI zero-copy send extension where the
+	server supports it, so it goes out with sendfile(2).  Otherwise it is
+	sent in large raw blocks, with no decoding or per-line work.
+
+	With a compress_level, the body is gzipped.  The history is compressed
+	once and cached, and each follower continues from a copy of the cached
+	compressor, flushing each new chunk of the live tail as it goes.
+	"""
+
+	def __init__(self, filename, start, end, base=0, head="", follower=None, compress_level=0, mtime_ns=0, archive=None, **kwargs):
+		""" Initialize the RoomResponse object; start and end are offsets in the full history, after the archive """
+		super().__init__((), **kwargs)
+		self.filename = filename
+		self.start = start
+		self.end = end
+		self.base = base
+		self.head = head
+		self.follower = follower
+		self.archive = archive
+		self.compress_level = compress_level
+		self.mtime_ns = mtime_ns
+		self.zerocopy = False
+		self.comp = None
+		self.crc = 0
+		self.size = 0
+
+	async def __call__(self, scope, receive, send):
+		""" Check if the server can send files for us """
+		self.zerocopy = ZEROCOPY_SEND in scope.get("extensions", {})
+		await super().__call__(scope, receive, send)
+
+	async def stream_response(self, send):
+		""" Send the head, the history, then follow the file """
+		await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+		if self.compress_level:
+			self.comp = deflater(self.compress_level)
+			await self.send_raw(send, GZIP_HEADER)
+		if self.head:
+			await self.send_body(send, self.head)
+		if self.archive:
+			while block := await asyncio.to_thread(next, self.archive, None):
+				await self.send_body(send, block)
+		if self.end > self.start:
+			await self.send_history(send)
+		if self.follower:
+			async for chunk in self.follower:
+				await self.send_body(send, chunk)
+		final = b""
+		if self.comp:
+			final = self.comp.flush() + struct.pack("<II", self.crc, self.size & 0xffffffff)
+		await send({"type": "http.response.body", "body": final, "more_body": False})
+
+	async def send_raw(self, send, data):
+		""" Send some data, as is """
+		await send({"type": "http.response.body", "body": data, "more_body": True})
+
+	async def send_body(self, send, chunk):
+		""" Send a chunk of the body, compressing it if need be """
+		if not isinstance(chunk, (bytes, memoryview)):
+			chunk = chunk.encode(self.charset)
+		if not chunk:
+			return
+		if self.comp:
+			self.crc = zlib.crc32(chunk, self.crc)
+			self.size += len(chunk)
+			chunk = self.comp.compress(chunk) + self.comp.flush(zlib.Z_SYNC_FLUSH)
+		await self.send_raw(send, chunk)
+
+	async def send_history(self, send):
+		""" Send the history from the file, zero-copy or precompressed if possible """
+		if self.comp:
+			# the cached history is a fresh deflate stream, so it can follow the flushed head
+			history = await compressed_history(self.filename, self.start, self.end, self.mtime_ns, self.compress_level)
+			await self.send_raw(send, history.data)
+			self.comp = history.comp.copy()
+			self.crc = crc32_combine(self.crc, history.crc, history.size)
+			self.size += history.size
+			return
+		if self.zerocopy and Path(self.filename).suffix != ".bb":
+			# only for files that are never compacted, as the range can't be checked once the server has it
+			with open(self.filename, "rb") as f:
+				await send({"type": ZEROCOPY_SEND, "file": f, "offset": self.start, "count": self.end - self.start, "more_body": True})
+			return
+		async for block in read_history(self.filename, self.base, self.start, self.end, block_size=SEND_BLOCK_SIZE):
+			await self.send_body(send, block)
 
 
 @app.route("/stream/{path:path}", methods=["GET"])
 async def stream(request):
-	""" Stream a file to the browser, like tail -f """
+	""" Stream a file to the browser, like tail -f
+
+	Query parameters:
+		offset: resume from this byte offset, also accepted as a Last-Event-ID header
+		last: start from the last N messages
+		end: don't follow, just send the history before this offset, for paging
+		full: for a bb file, start from the archived history, see room_archive.py
+
+	Offsets are in the full history of a bb file, so they hold when the room
+	is compacted: the live file starts after the archived history.  Earlier
+	offsets are sent from the archive.  Without an offset, the body starts at
+	the live file, or the start of the archived history with full.
+
+	The X-Offset response header gives the byte offset where the body starts.
+	X-Archived gives the size of the archived history.
+	"""
 	global templates  # pylint: disable=global-statement, global-variable-not-assigned
 
 	path = request.path_params['path']
@@ -98,9 +555,47 @@ async def stream(request):
 			head = templates.get_template("room-head.html").render(context)
 		keepalive_string = HTML_KEEPALIVE
 
-	logger.info("tail: %s", safe_path)
-	follower = follow(str(safe_path), head=head, keepalive_string=keepalive_string)
-	return StreamingResponse(follower, media_type=media_type)
+	offset = get_int_param(request, "offset", header="Last-Event-ID")
+	last = get_int_param(request, "last")
+	end = get_int_param(request, "end")
+	full = get_int_param(request, "full")
+
+	base, size, mtime_ns = history_size(safe_path)
+
+	if offset is not None and offset > size:
+		# the file was truncated or rotated, so start again
+		logger.info("offset %d beyond end of %s, starting again", offset, safe_path)
+		offset = None
+	if offset is None and last:
+		offset = base + await last_messages_offset(str(safe_path), last, end=None if end is None else max(0, end - base))
+	if offset is None:
+		offset = 0 if full else base
+
+	headers = {"X-Offset": str(offset), "Vary": "Accept-Encoding"}
+	if base:
+		headers["X-Archived"] = str(base)
+
+	history_end = size if end is None else min(end, size)
+	archive = None
+	if offset < min(base, history_end):
+		archive = room_archive.history_blocks(safe_path, start=offset, end=min(base, history_end), block_size=SEND_BLOCK_SIZE, live=False)
+	live_start = max(offset, base)
+	live_end = max(history_end, live_start)
+
+	compress_level = COMPRESS_LEVELS.get(media_type, 0)
+	if compress_level and "gzip" in request.headers.get("Accept-Encoding", ""):
+		headers["Content-Encoding"] = "gzip"
+	else:
+		compress_level = 0
+
+	if end is not None:
+		logger.info("range: %s %d %d", safe_path, offset, history_end)
+		return RoomResponse(str(safe_path), live_start, live_end, base=base, compress_level=compress_level, mtime_ns=mtime_ns, archive=archive, media_type=media_type, headers=headers)
+
+	# send the history up to the current size directly, then hand over to the hub at that exact offset
+	logger.info("tail: %s from %d, history to %d", safe_path, offset, size)
+	follower = follow(str(safe_path), start=max(offset, size), keepalive_string=keepalive_string)
+	return RoomResponse(str(safe_path), live_start, live_end, base=base, head=head, follower=follower, compress_level=compress_level, mtime_ns=mtime_ns, archive=archive, media_type=media_type, headers=headers)
 
 
 if __name__ == "__main__":